@@ -1,8 +1,8 @@
 import argparse
+import atexit
 import asyncio
 from collections import deque
 from enum import Enum
-import json
 import math
 import time
 import serial_asyncio
@@ -12,19 +12,42 @@ from rtmidi.midiutil import open_midiinput
 from rtmidi import midiconstants
 import random
 from message import *
+from wire import SUBPROTOCOLS, Batch, broadcast, observers
+from clients import SEND_BUFFER_HIGH, serve_client, stats_endpoint
+from knobs import KNOB_FLUSH_HZ, KnobCoalescer
+from fanout import serve_workers
+from relay import relay_loop
+from state import StateModel
+from midi import MidiParser
+from clock import ClockTracker
+from scenes import SceneScheduler
+from capture import MidiCapture, read_capture
+from ticker import Ticker
+import log
+from apc40_control import DEFAULT_PORT as APC40_DEFAULT_PORT, main_loop_apc40
 from beatdetect import PredictiveBeatDetector
 import sys
 
 USE_STROBE = False
 USE_LEDS = False
 FAKE_KNOB_MOVEMENT = False
-BEAT_RESET_TIMEOUT_S = 1
 WS_PORT = 8765
-MIN_BPM_SAMPLES = 4 * 24
-NUM_BPM_SAMPLES = 16 * 24
 
-LOG_MSGS = False
-LOG_SYNC = False
+# rtmidi timestamps each message by its delta from the previous one, taken by
+# the MIDI driver as it arrived. Summed from an anchor on time.time(), they
+# give arrival times free of the callback thread's scheduling delay. The sum
+# is pulled back to the wall clock when it runs ahead of it (the anchor was
+# late) or falls further than this behind (clock drift, or a reset port).
+RTMIDI_MAX_LAG_S = 0.02
+
+# The flywheel's watchdog hands an overdue tick to its Ticker this long
+# before it is due, leaving the Ticker time to wake for it precisely.
+FLYWHEEL_WATCHDOG_LEAD_S = 0.005
+
+# Most bytes read from the serial port at once. At 31250 baud MIDI carries
+# about 3 bytes per millisecond, so a read returns whatever arrived since the
+# last one rather than waiting to fill this.
+SERIAL_READ_SIZE = 256
 
 # MIDI control-change values are 7-bit (0..127); we normalize them to [0, 1]
 # before sending so the client deals only in normalized knob values.
@@ -49,95 +72,9 @@ if USE_STROBE:
     strobe = dmx.add_fixture(Custom, name="ADJ Mega Flash", channels=2)
 
 
-class ClockTracker:
-    def __init__(self):
-        self.sync_rate_hz = 120 / 60 * 24
-        self.cur_sync_idx = -1      # Starts at -1 so first beat (ping, then send) will be beat 0
-        self._last_clock_est = None
-        self._samples = deque()
-        self.sync = False
-
-
-    def ping(self):
-        now = time.time()
-        elapsed = 0
-
-        if self._last_clock_est != None:
-            elapsed = now - self._last_clock_est
-            if elapsed > BEAT_RESET_TIMEOUT_S:
-                self.reset_sync()
-
-        self._last_clock_est = now
-
-        self._samples.append(now)
-
-        if self.sync:
-            est_syncs_elapsed = round(elapsed * self.sync_rate_hz)
-            #print(f'est syncs elapsed: {est_syncs_elapsed}')
-
-        self.cur_sync_idx += 1
-
-        while len(self._samples) > NUM_BPM_SAMPLES:
-            self._samples.popleft()
-
-        if len(self._samples) >= MIN_BPM_SAMPLES and sum(self._samples) > 0:
-            self.sync_rate_hz = (len(self._samples) - 1) / (self._samples[-1] - self._samples[0])
-            self.sync = True
-
-
-
-    def reset_sync(self):
-        self.cur_sync_idx = -1
-        self._last_clock = None
-        self._samples.clear()
-        self.sync = False
-    
-
-
 clock_tracker = ClockTracker()
 
 
-NUM_SCENES = 23
-
-class SceneCycler:
-    def __init__(self, cycle_interval):
-        self.cycle_interval = cycle_interval * 4 * 24   # 24 syncs per beat
-        self.cur_scenes = [1, 0]  # [fg, bg]
-
-    def check_cycle(self, sync_idx):
-        """Returns a list of MsgGotoScene if it's time to cycle, otherwise None."""
-        if self.cycle_interval == 0 or sync_idx % self.cycle_interval != 0:
-            return None
-
-        fg, bg = self.cur_scenes
-        messages = []
-
-        if fg and bg:
-            # Both have scenes: blank fg
-            self.cur_scenes[0] = 0
-            messages.append(MsgGotoScene(0, 0, False))
-        else:
-            # At least one blank: add new scene
-            if fg == 0 and bg:
-                # Promote bg to fg first
-                messages.append(MsgGotoScene(0, bg, False))
-                self.cur_scenes[0] = bg
-            # Add new scene to bg (or fg if both were blank)
-            new_scene = random.randint(1, NUM_SCENES)
-            target_bg = (self.cur_scenes[0] != 0)
-            self.cur_scenes[1 if target_bg else 0] = new_scene
-            messages.append(MsgGotoScene(0, new_scene, target_bg))
-
-        return messages
-
-    def check_advance(self, sync_idx):
-        """Returns a MsgAdvanceSceneState if we're at the halfway point between scene changes."""
-        if (self.cycle_interval != 0 and sync_idx % self.cycle_interval == self.cycle_interval // 2):
-            return MsgAdvanceSceneState(0, 1)
-        else:
-            return None
-
-
 def to_hex(st):
     return ':'.join(hex(ord(x))[2:] for x in st)
 
@@ -175,33 +112,35 @@ for bar in range(0, NUM_BARS):
             fake_beat[16 * bar + i].append(9)
 
 
-def translate_note_to_msg(channel, note_number, note_vel, last_transmit_latency=0, use_note_syncs=False):
-    print(f'{channel}:{note_number}:{note_vel}')
+def translate_note_to_msg(channel, note_number, note_vel, last_transmit_latency=0, use_note_syncs=False, t=None):
+    log.notes('%d:%d:%d', channel, note_number, note_vel)
     if note_vel == 0:
         return None
 
     ws_msg = None
     if channel == 16 and use_note_syncs:
         # This channel is used for synchronization
-        clock_tracker.ping()
+        clock_tracker.ping(t)
         if clock_tracker.sync:
             ws_msg = MsgSync(last_transmit_latency, clock_tracker.sync_rate_hz, clock_tracker.cur_sync_idx)
-            if LOG_SYNC:
-                print(f'sync_rate_bpm: {clock_tracker.sync_rate_hz * 60 / 24}')
-                print(f'beat: {clock_tracker.cur_sync_idx // 24}')
+            ws_msg.t = clock_tracker.tick_t
+            log.sync('sync_rate_bpm: %s  beat: %d', clock_tracker.sync_rate_hz * 60 / 24,
+                     clock_tracker.cur_sync_idx // 24)
     elif channel == 15:
         # Analog Rytm auto channel
         if note_number >= 12 and note_number < 36:
             ws_msg = MsgGotoScene(last_transmit_latency, note_number - 12, note_vel < 100)
         elif note_number >= 36:
-            print(f'advancing {-1 if note_number % 2 == 0 else 1}')
+            log.notes('advancing %d', -1 if note_number % 2 == 0 else 1)
             ws_msg = MsgAdvanceSceneState(last_transmit_latency, -1 if note_number % 2 == 0 else 1)
         else:
             ws_msg = MsgBeat(last_transmit_latency, note_number + 1, True)
 
     elif channel == 14:
-        # This channel is used for graphics scene switching
-        ws_msg = MsgGotoScene(last_transmit_latency, note_number - 60, note_vel < 100)
+        # This channel is used for graphics scene switching, from middle C
+        # up; notes below it are no scene.
+        if note_number >= 60:
+            ws_msg = MsgGotoScene(last_transmit_latency, note_number - 60, note_vel < 100)
     elif channel == 13:
         # This channel is used for moving forward/backward in the graphics scene
         ws_msg = MsgAdvanceSceneState(last_transmit_latency, 1)
@@ -221,229 +160,343 @@ def translate_note_to_msg(channel, note_number, note_vel, last_transmit_latency=
     return ws_msg
 
 
-class RtMidiInputHandler:
-    def __init__(self, websocket):
-        self.websocket = websocket
-
-    def __call__(self, event, data=None):
-        t_callback = time.time()
-        message, deltatime = event
-        ws_msg = self.translate_midi_msg(message)
-        if ws_msg:
-            self.websocket.send(ws_msg.to_json())
-
-
-    def translate_midi_msg(self, midi_msg):
-        ws_msg = None
-        if (midi_msg[0] & 0xF0 == NOTE_ON) and midi_msg[2] != 0:
-            channel = (midi_msg[0] & 0xF) + 1
-            note_number = midi_msg[1]
-            note_vel = midi_msg[2]
-            if channel == 15:   # Analog Rytm auto channel
-                channel = note_number
-                note_number = note_vel
-        elif midi_msg[0] & 0xF0 == NOTE_OFF:
-            if channel == 15:
-                if USE_STROBE:
-                    strobe_off()
-        elif midi_msg[0] & 0xF0 == CONTROL_CHANGE:
-            control_idx = midi_msg[1]
-            control_val = midi_msg[2]
-            # This channel is used for graphics scene switching
-            #ws_msg = MsgGotoScene(last_msg_latency, int(control_val / 5), control_idx > 1)
-            ws_msg = MsgControlChange(last_msg_latency, control_idx, control_val / MIDI_CC_MAX)
-
-        if ws_msg != None and LOG_MSGS:
-            print(ws_msg)
-
-        return ws_msg
-
-
-# Set of connected viewer clients
+# Set of connected viewer clients (clients.Client). Each client tracks its
+# own latency, which is stamped on the frames sent to it.
 connected = set()
 
+# Show state for clients that join mid-set. It follows everything broadcast
+# as one of wire.observers (see state.py).
+show_state = StateModel()
+observers.append(show_state)
+
 # Connected adapter client
 adapter = None
 adapter_secret = None
 
-# Last message's roundtrip latency divided by two, in seconds
-last_msg_latency = 0.0
-
 async def handler(websocket):
-    global last_msg_latency
-    connected.add(websocket)
-    print("Client connected")
-    try:
-        async for message in websocket:
-            msg = json.loads(message)
-            last_msg_latency = (time.time() - msg['t']) / 2
-            #print(last_msg_latency)
-    finally:
-        # Unregister client
-        connected.remove(websocket)
-        print("Client disconnected")
+    await serve_client(connected, websocket, show_state)
 
 
-class SerialMidiHandler:
+class MidiHandler:
+    """Turns a raw MIDI byte stream (from the serial port, or messages from
+    rtmidi) into adapter messages. A MidiParser splits the stream into MIDI
+    messages, which are dispatched through a table indexed by status byte."""
+
     def __init__(self):
-        self.bytes = []
+        self.parser = MidiParser()
         self.playing = True
+        self._handlers = [None] * 256
+        self._handlers[midiconstants.TIMING_CLOCK] = self.on_clock
+        self._handlers[midiconstants.SONG_START] = self.on_start
+        self._handlers[midiconstants.SONG_CONTINUE] = self.on_continue
+        self._handlers[midiconstants.SONG_STOP] = self.on_stop
+        for channel in range(16):
+            self._handlers[midiconstants.NOTE_ON | channel] = self.on_note_on
+            self._handlers[midiconstants.CONTROL_CHANGE | channel] = self.on_control_change
+            self._handlers[midiconstants.PROGRAM_CHANGE | channel] = self.on_program_change
+            self._handlers[midiconstants.PITCH_BEND | channel] = self.on_pitch_bend
+
+    def handle_midi_bytes(self, buf, t=None):
+        """Parse a chunk of the stream that arrived at `t` (default now);
+        return the messages it completes, stamped with `t` rather than the
+        time they were parsed. Syncs are stamped with the clock tracker's
+        smoothed tick time instead."""
+        if t is None:
+            t = time.time()
+        ws_msgs = []
+        handlers = self._handlers
+        for midi_msg in self.parser.feed(buf):
+            handler = handlers[midi_msg[0]]
+            if handler is not None:
+                ws_msg = handler(midi_msg, t)
+                if ws_msg is not None:
+                    if ws_msg.msg_type != Msg.Type.SYNC:
+                        ws_msg.t = t
+                    ws_msgs.append(ws_msg)
+        return ws_msgs
+
+    def on_clock(self, midi_msg, t):
+        if clock_tracker.ping(t) and clock_tracker.sync and self.playing:
+            log.sync('sync_rate_bpm: %s  beat: %d', clock_tracker.sync_rate_hz * 60 / 24,
+                     clock_tracker.cur_sync_idx // 24)
+            return self.sync_msg()
+        return None
 
-    def handle_midi_byte(self, b):
-        ws_msg = None
-        if len(self.bytes) == 0:
-            # First byte
-            if b == midiconstants.TIMING_CLOCK:
-                # Single-byte message
-                clock_tracker.ping()
-                if clock_tracker.sync and self.playing:
-                    #print(f'Sync idx: {clock_tracker.cur_sync_idx}')
-                    ws_msg = MsgSync(last_msg_latency, clock_tracker.sync_rate_hz, clock_tracker.cur_sync_idx)
-                    if LOG_SYNC:
-                        print(f'sync_rate_bpm: {clock_tracker.sync_rate_hz * 60 / 24}')
-                        print(f'beat: {clock_tracker.cur_sync_idx // 24}')
-                self.bytes = []
-            elif b == midiconstants.SONG_STOP:
-                # Single-byte message
-                self.playing = False
-                self.bytes = []
-            elif b == midiconstants.SONG_START:
-                # Single-byte message
-                self.playing = True
-                clock_tracker.reset_sync()
-                self.bytes = []
-            elif b == midiconstants.SONG_CONTINUE:
-                # Single-byte message
-                self.playing = True
-                self.bytes = []
-            elif b & 0xF0 == midiconstants.NOTE_ON:
-                self.bytes = [b]
-            elif b & 0xF0 == midiconstants.NOTE_OFF:
-                self.bytes = [b]
-            elif b & 0xF0 == midiconstants.CONTROL_CHANGE:
-                self.bytes = [b]
-            elif b & 0xF0 == midiconstants.PROGRAM_CHANGE:
-                self.bytes = [b]
-            elif b & 0xF0 == midiconstants.PITCH_BEND:
-                self.bytes = [b]
-            elif b & 0xF0 == 0xA0:
-                self.bytes = [b]
-            else:
-                print(f'unknown status byte: {b}')
-                pass
-        else:
-            # This is not the first byte
-            if self.bytes[0] & 0xF0 == midiconstants.NOTE_ON:
-                self.bytes.append(b)
-                if len(self.bytes) == 3:
-                    channel = (self.bytes[0] & 0xF) + 1
-                    note_number, note_vel = self.bytes[1:]
-                    ws_msg = translate_note_to_msg(channel, note_number, note_vel)
-                    self.bytes = []
-            elif self.bytes[0] & 0xF0 == midiconstants.NOTE_OFF:
-                self.bytes.append(b)
-                if len(self.bytes) == 3:
-                    channel = (self.bytes[0] & 0xF) + 1
-                    note_number, note_vel = self.bytes[1:]
-                    ws_msg = None
-                    self.bytes = []
-            elif self.bytes[0] & 0xF0 == midiconstants.CONTROL_CHANGE:
-                self.bytes.append(b)
-                if len(self.bytes) == 3:
-                    print(f"control change: {self.bytes[1:]}")
-                    control_idx, control_val = self.bytes[1:]
-                    # This channel is used for graphics scene switching
-                    ws_msg = MsgControlChange(last_msg_latency, control_idx, control_val / MIDI_CC_MAX)
-                    #ws_msg = MsgGotoScene(last_msg_latency, int(control_val / 5), control_idx > 1)
-                    self.bytes = []
-            elif self.bytes[0] & 0xF0 == midiconstants.PITCH_BEND:
-                self.bytes.append(b)
-                if len(self.bytes) == 3:
-                    value_lo, value_hi = self.bytes[1:]
-                    value = (value_hi << 7) | value_lo
-                    ws_msg = MsgPitchBend(last_msg_latency, value)
-                    self.bytes = []
-            elif self.bytes[0] & 0xF0 == midiconstants.PROGRAM_CHANGE:
-                self.bytes.append(b)
-                channel = (self.bytes[0] & 0xF) + 1
-                value = self.bytes[1]
-                print(f'program change: {channel} {value}')
-                clock_tracker.cur_sync_idx = -1
-                ws_msg = MsgProgramChange(last_msg_latency, channel, value)
-                self.bytes = []
-            elif self.bytes[0] & 0xF0 == 0xA0:
-                self.bytes.append(b)
-                if len(self.bytes) == 3:
-                    channel = self.bytes[1] + 1
-                    self.bytes = []
-            else:
-                self.bytes = []
+    def on_flywheel(self, now):
+        """Coast the clock tracker over an overdue tick; return the sync to
+        send for it, if any."""
+        if clock_tracker.coast(now) and self.playing:
+            log.sync('coasting: beat %d', clock_tracker.cur_sync_idx // 24)
+            return self.sync_msg()
+        return None
 
+    @staticmethod
+    def sync_msg():
+        ws_msg = MsgSync(0, clock_tracker.sync_rate_hz, clock_tracker.cur_sync_idx)
+        ws_msg.t = clock_tracker.tick_t
         return ws_msg
 
+    def on_start(self, midi_msg, t):
+        self.playing = True
+        clock_tracker.reset_sync()
+
+    def on_continue(self, midi_msg, t):
+        self.playing = True
+
+    def on_stop(self, midi_msg, t):
+        self.playing = False
+
+    def on_note_on(self, midi_msg, t):
+        status, note_number, note_vel = midi_msg
+        return translate_note_to_msg((status & 0xF) + 1, note_number, note_vel, t=t)
+
+    def on_control_change(self, midi_msg, t):
+        _status, control_idx, control_val = midi_msg
+        log.cc('control change: [%d, %d]', control_idx, control_val)
+        # This channel is used for graphics scene switching
+        #return MsgGotoScene(0, int(control_val / 5), control_idx > 1)
+        return MsgControlChange(0, control_idx, control_val / MIDI_CC_MAX)
+
+    def on_program_change(self, midi_msg, t):
+        status, value = midi_msg
+        channel = (status & 0xF) + 1
+        log.cc('program change: %d %d', channel, value)
+        clock_tracker.cur_sync_idx = -1
+        return MsgProgramChange(0, channel, value)
+
+    def on_pitch_bend(self, midi_msg, t):
+        _status, value_lo, value_hi = midi_msg
+        return MsgPitchBend(0, (value_hi << 7) | value_lo)
+
+
+
+class RtMidiInputHandler:
+    """rtmidi callback, run on rtmidi's own thread. Appends each MIDI message
+    and its arrival time to a deque, whose appends and pops are atomic so no
+    lock is needed, and wakes the event loop to drain it, at most once per
+    batch."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.events = deque()
+        self.ready = asyncio.Event()
+        self._wakeup_pending = False
+        self._last_t = None
+
+    def __call__(self, event, data=None):
+        message, deltatime = event
+        now = time.time()
+        if self._last_t is None:
+            t = now
+        else:
+            t = min(now, max(now - RTMIDI_MAX_LAG_S, self._last_t + deltatime))
+        self._last_t = t
+        self.events.append((message, t))
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def batches(self):
+        """Yield lists of the (MIDI message, arrival time) pairs received
+        since the last batch."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            # Cleared before draining: a message appended after this point
+            # schedules a new wakeup, and one appended before is drained.
+            self._wakeup_pending = False
+            batch = []
+            while self.events:
+                batch.append(self.events.popleft())
+            yield batch
+
+
+def dispatch_midi_msgs(ws_msgs, batch, knobs, msg_queue, scene_scheduler):
+    """Route messages from a MidiHandler: control changes to the knob
+    coalescer, the rest to `batch`, plus any scene changes the scheduler
+    has coming up at each sync."""
+    for ws_msg in ws_msgs:
+        if ws_msg.msg_type != Msg.Type.SYNC:
+            log.msgs('%s', ws_msg)
+
+        if ws_msg.msg_type == Msg.Type.CONTROL_CHANGE:
+            knobs.add(ws_msg)
+        else:
+            batch.add(ws_msg)
+        msg_queue.put_nowait(ws_msg)
+
+        if scene_scheduler and ws_msg.msg_type == Msg.Type.SYNC:
+            for msg in scene_scheduler.on_sync(ws_msg.sync_idx):
+                batch.add(msg)
+
+
+async def run_flywheel(handler, emit):
+    """Keep `handler`'s syncs coming while its MIDI clock is silent: coast
+    over each tick that is overdue (see ClockTracker.coast), passing the
+    syncs to `emit` like the handler's own.
+
+    While the clock is running, a plain asyncio timer watches for it going
+    quiet, moved on by each tick. Only once a tick is about to be overdue is
+    a Ticker armed to time the coasted ticks; it disarms as soon as the
+    clock is back."""
+    coasting = False
+
+    def on_tick(deadline):
+        nonlocal coasting
+        due_t = clock_tracker.coast_due_t()
+        if due_t is None or deadline < due_t:
+            # The clock came back (moving the due time) or was reset.
+            coasting = False
+            ticker.arm(None)
+            return
+        ws_msg = handler.on_flywheel(deadline)
+        if ws_msg is not None:
+            emit([ws_msg])
+        # None once the tempo is given up on.
+        due_t = clock_tracker.coast_due_t()
+        coasting = due_t is not None
+        ticker.arm(due_t)
+
+    ticker = Ticker('flywheel', on_tick)
+    ticker_task = asyncio.create_task(ticker.run())
+    try:
+        while True:
+            due_t = clock_tracker.coast_due_t()
+            if coasting or due_t is None:
+                await asyncio.sleep(clock_tracker.period_s)
+                continue
+            wait = due_t - FLYWHEEL_WATCHDOG_LEAD_S - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            # No tick since: hand the due time to the Ticker.
+            coasting = True
+            ticker.arm(due_t)
+    finally:
+        ticker_task.cancel()
 
 
-async def main_loop_rtmidi(rtmidi_device):
+async def main_loop_rtmidi(rtmidi_device, msg_queue, knobs, cycle=0, capture=None):
+    midiin, port_name = open_midiinput(rtmidi_device)
+    flywheel = None
     try:
-        midiin = rtmidi.MidiIn()
-        midiin, _ = open_midiinput(args.rtmidi)
-        async with websockets.serve(handler, "0.0.0.0", WS_PORT):
-            midi_handler = RtMidiInputHandler(websocket)
-            midiin.set_callback(midi_handler)
-            while True:
-                time.sleep(1)
+        # rtmidi drops clock messages unless told otherwise.
+        midiin.ignore_types(sysex=True, timing=False, active_sense=True)
+        rtmidi_handler = RtMidiInputHandler(asyncio.get_running_loop())
+        midiin.set_callback(rtmidi_handler)
+        print(f'Receiving MIDI from "{port_name}"')
+        handler = MidiHandler()
+        scene_scheduler = SceneScheduler(cycle) if cycle != 0 else None
+        batch = Batch(connected)
+        def emit(ws_msgs):
+            dispatch_midi_msgs(ws_msgs, batch, knobs, msg_queue, scene_scheduler)
+            batch.flush()
+        flywheel = asyncio.create_task(run_flywheel(handler, emit))
+        async for midi_msgs in rtmidi_handler.batches():
+            # Each is a complete MIDI message; they go through the same
+            # parser as serial bytes.
+            ws_msgs = []
+            for midi_msg, t in midi_msgs:
+                if capture:
+                    capture.write(midi_msg, t)
+                ws_msgs += handler.handle_midi_bytes(midi_msg, t)
+            emit(ws_msgs)
     finally:
+        if flywheel:
+            flywheel.cancel()
         midiin.close_port()
         del midiin
 
 
-async def main_loop_serial(serial_device, msg_queue, cycle=0):
+async def main_loop_serial(serial_device, msg_queue, knobs, cycle=0, capture=None):
     reader, _ = await serial_asyncio.open_serial_connection(url=serial_device, baudrate=31250)
-    handler = SerialMidiHandler()
-    scene_cycler = SceneCycler(cycle) if cycle != 0 else None
-    while True:
-        byte = int.from_bytes(await reader.read(1))
-        ws_msg = handler.handle_midi_byte(byte)
-
-        if ws_msg and ws_msg.msg_type != Msg.Type.SYNC and LOG_MSGS:
-            print(ws_msg)
-
-        if ws_msg:
-            websockets.broadcast(connected, ws_msg.to_json())
-            msg_queue.put_nowait(ws_msg)
-
-        if scene_cycler:
-            cycle_msgs = scene_cycler.check_cycle(clock_tracker.cur_sync_idx)
-            if cycle_msgs:
-                for msg in cycle_msgs:
-                    websockets.broadcast(connected, msg.to_json())
-            advance_msg = scene_cycler.check_advance(clock_tracker.cur_sync_idx)
-            if advance_msg:
-                websockets.broadcast(connected, advance_msg.to_json())
+    handler = MidiHandler()
+    scene_scheduler = SceneScheduler(cycle) if cycle != 0 else None
+    batch = Batch(connected)
+    def emit(ws_msgs):
+        dispatch_midi_msgs(ws_msgs, batch, knobs, msg_queue, scene_scheduler)
+        batch.flush()
+    flywheel = asyncio.create_task(run_flywheel(handler, emit))
+    try:
+        while True:
+            # Whatever has arrived, up to SERIAL_READ_SIZE bytes; at least one.
+            # The loop is usually waiting in read(), so the bytes arrived about
+            # when it returns.
+            buf = await reader.read(SERIAL_READ_SIZE)
+            t = time.time()
+            if capture:
+                capture.write(buf, t)
+            emit(handler.handle_midi_bytes(buf, t))
+    finally:
+        flywheel.cancel()
+
+
+async def main_loop_replay(path, speed, msg_queue, knobs, cycle=0):
+    """Feed a capture file (see capture.py) through the MIDI pipeline, `speed`
+    times as fast as it was recorded, or at speed 0 as fast as possible.
+    Messages are stamped with their arrival time on the recording's
+    timeline scaled by `speed`, as they are fed in, so ClockTracker tracks
+    the recorded tempo times `speed`: only speeds 1 and 0 (which keeps the
+    recorded times, unscaled) give it the recorded timing. Reports
+    throughput and, when paced, how late each record was fed."""
+    records = read_capture(path)
+    handler = MidiHandler()
+    scene_scheduler = SceneScheduler(cycle) if cycle != 0 else None
+    batch = Batch(connected)
+    def emit(ws_msgs):
+        dispatch_midi_msgs(ws_msgs, batch, knobs, msg_queue, scene_scheduler)
+        batch.flush()
+    num_msgs = 0
+    lateness = []
+    print(f'Replaying {len(records)} records from {path}' + (f' at {speed}x' if speed else ''))
+    t0 = time.time()
+    start = time.perf_counter()
+    # Paced replays coast through dropouts in the recording, as live input would.
+    flywheel = asyncio.create_task(run_flywheel(handler, emit)) if speed else None
+    for t_rec, buf in records:
+        if speed:
+            t_due = t_rec / speed
+            delay = t_due - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            lateness.append(time.perf_counter() - start - t_due)
+        else:
+            # Let clients be served between records.
+            await asyncio.sleep(0)
+        ws_msgs = handler.handle_midi_bytes(buf, t0 + t_rec / (speed or 1))
+        num_msgs += len(ws_msgs)
+        emit(ws_msgs)
+    if flywheel:
+        flywheel.cancel()
+    elapsed = time.perf_counter() - start
+    num_bytes = sum(len(buf) for _, buf in records)
+    print(f'Replayed {num_bytes} bytes, {num_msgs} messages in {elapsed:.3f} s: '
+          f'{num_bytes / elapsed / 1e3:.1f} kB/s, {num_msgs / elapsed:.0f} msgs/s')
+    if lateness:
+        lateness.sort()
+        p = lambda q: lateness[min(len(lateness) - 1, int(q * len(lateness)))] * 1e3
+        print(f'Replay lateness: p50 {p(0.5):.3f} ms  p99 {p(0.99):.3f} ms  max {lateness[-1] * 1e3:.3f} ms')
 
 
 async def main_loop_fake(bpm, cycle=0):
-    global last_msg_latency
     sync_idx = 0
     beat_idx = 0
     sync_rate_hz = (bpm * 24) / 60
     state_advancing = True
     cur_advance_step = 1
     cur_advance_state = 0
-    scene_cycler = SceneCycler(cycle) if cycle != 0 else None
-    start_time = time.time()
-    while True:
-        sync_msg = MsgSync(last_msg_latency, sync_rate_hz, sync_idx)
-        websockets.broadcast(connected, sync_msg.to_json())
-
-        if scene_cycler:
-            cycle_msgs = scene_cycler.check_cycle(sync_idx)
-            if cycle_msgs:
-                for msg in cycle_msgs:
-                    websockets.broadcast(connected, msg.to_json())
-            advance_msg = scene_cycler.check_advance(sync_idx)
-            if advance_msg:
-                websockets.broadcast(connected, advance_msg.to_json())
+    scene_scheduler = SceneScheduler(cycle) if cycle != 0 else None
+    batch = Batch(connected)
+    def on_tick(deadline):
+        nonlocal sync_idx, beat_idx
+        sync_msg = MsgSync(0, sync_rate_hz, sync_idx)
+        # Stamped with when the tick was due, not when the loop got to it.
+        sync_msg.t = deadline
+        batch.add(sync_msg)
+
+        if scene_scheduler:
+            for msg in scene_scheduler.on_sync(sync_idx):
+                batch.add(msg)
         new_beat_idx = sync_idx // 6
         if new_beat_idx != beat_idx:
             beat_idx = new_beat_idx
@@ -474,52 +527,89 @@ async def main_loop_fake(bpm, cycle=0):
                 cur_scenes[1 if bg else 0] = new_scene'''
 
             for beat in cur_beats:
-                beat_msg = MsgBeat(last_msg_latency, beat)
-                websockets.broadcast(connected, beat_msg.to_json())
+                beat_msg = MsgBeat(0, beat)
+                beat_msg.t = deadline
+                batch.add(beat_msg)
+        batch.flush()
         sync_idx += 1
-        next_tick_time = start_time + sync_idx / sync_rate_hz
-        await asyncio.sleep(max(0, next_tick_time - time.time()))
+    ticker = Ticker('fake clock', on_tick)
+    ticker.arm(time.time(), 1 / sync_rate_hz)
+    await ticker.run()
 
 
-async def main_loop_FAKE_KNOB_MOVEMENT(bpm):
-    """Continuously broadcast fake control-change messages for 16 phase-offset
-    sinusoids, independent of the sync clock, for smooth knob motion."""
+async def main_loop_FAKE_KNOB_MOVEMENT(bpm, knobs):
+    """Continuously generate fake control-change messages for 16 phase-offset
+    sinusoids, independent of the sync clock, for smooth knob motion. They go
+    through the knob coalescer like real controller input."""
     beat_s = 60.0 / bpm
     start_time = time.time()
     period_s = [(0.5 + random.random()) * FAKE_KNOB_PERIOD_BEATS * beat_s for i in range(FAKE_KNOB_COUNT)]
-    while True:
-        elapsed = time.time() - start_time
+    def on_tick(deadline):
+        elapsed = deadline - start_time
         for knob in range(FAKE_KNOB_COUNT):
             phase = 2 * math.pi * (elapsed - knob * beat_s) / period_s[knob]
             # Normalized [0, 1] value, left unquantized for smooth motion.
             value = (math.sin(phase) + 1) / 2
-            cc_msg = MsgControlChange(last_msg_latency, knob, value)
-            websockets.broadcast(connected, cc_msg.to_json())
-        await asyncio.sleep(1.0 / FAKE_KNOB_UPDATE_HZ)
+            cc_msg = MsgControlChange(0, knob, value)
+            knobs.add(cc_msg)
+    ticker = Ticker('fake knobs', on_tick)
+    ticker.arm(start_time, 1.0 / FAKE_KNOB_UPDATE_HZ)
+    await ticker.run()
 
 
 async def main_loop_audio(device):
     loop = asyncio.get_running_loop()
     def on_beat(channel, latency_s):
-        loop.call_soon_threadsafe(websockets.broadcast, connected, MsgBeat(latency_s, channel).to_json())
+        loop.call_soon_threadsafe(broadcast, connected, MsgBeat(latency_s, channel))
     def on_sync(sync_rate_hz, sync_idx):
-        loop.call_soon_threadsafe(websockets.broadcast, connected, MsgSync(0, sync_rate_hz, sync_idx).to_json())
+        loop.call_soon_threadsafe(broadcast, connected, MsgSync(0, sync_rate_hz, sync_idx))
     detector = PredictiveBeatDetector(on_beat=on_beat, on_sync=on_sync)
     await asyncio.to_thread(detector.run_mic, device)
 
 
 async def main():
-    parser = argparse.ArgumentParser(description="Rave MIDI -> web adapter")
-    parser.add_argument('-f', '--fake', type=float, help='fake MIDI events with given BPM')
-    parser.add_argument('-d', '--device', type=str, help='Receive MIDI messages on specified tty (default /dev/ttyserial0)')
-    parser.add_argument('-r', '--rtmidi', type=str, help='Use rtmidi with specified MIDI device (string e.g. Volt)')
+    parser = argparse.ArgumentParser(description="Rave MIDI -> web adapter. Takes one clock source (--fake, --device, "
+                                                 "--rtmidi, --replay, --audio or --relay) and any of the knob "
+                                                 "sources (--apc40, --mouse); they all feed the same websocket.")
+    # Each clock source numbers its own syncs, so only one may run.
+    clock_source = parser.add_mutually_exclusive_group()
+    clock_source.add_argument('-f', '--fake', type=float, help='fake MIDI events with given BPM')
+    clock_source.add_argument('-d', '--device', type=str, help='Receive MIDI messages on specified tty (default /dev/ttyserial0)')
+    clock_source.add_argument('-r', '--rtmidi', type=str, help='Use rtmidi with specified MIDI device (string e.g. Volt)')
+    parser.add_argument('--apc40', type=str, nargs='?', const=APC40_DEFAULT_PORT, metavar='PORT',
+                        help=f'Take knobs from an APC40 mkII on the given MIDI input port (default {APC40_DEFAULT_PORT})')
+    parser.add_argument('--mouse', action='store_true',
+                        help='Take two knobs from the mouse position (macOS only)')
+    clock_source.add_argument('--relay', type=str, metavar='URL',
+                              help='Re-broadcast the stream of another adapter (e.g. ws://upstream:8765)')
+    parser.add_argument('--capture', type=str, metavar='FILE',
+                        help='Record the MIDI input of --device or --rtmidi to FILE, for --replay')
+    clock_source.add_argument('--replay', type=str, metavar='FILE',
+                              help='Replay MIDI input recorded with --capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Replay speed, as a multiple of real time; 0 replays as fast as possible. Default is 1.')
+    parser.add_argument('-p', '--port', type=int, default=WS_PORT,
+                        help=f'Websocket port to serve clients on. Default is {WS_PORT}.')
     parser.add_argument('-c', '--cycle', type=int, default=0, help='Periodically cycle scenes every N bars. Default is 0 (do not cycle).')
-    parser.add_argument('-a', '--audio', type=int, metavar='DEVICE',
-                        help='Use audio beat detection with given device index')
+    clock_source.add_argument('-a', '--audio', type=int, metavar='DEVICE',
+                              help='Use audio beat detection with given device index')
+    parser.add_argument('-k', '--knob-rate', type=float, default=KNOB_FLUSH_HZ,
+                        help=f'Rate in Hz at which knob (control change) updates are sent. Default is {KNOB_FLUSH_HZ}.')
+    parser.add_argument('-w', '--workers', type=int, default=0,
+                        help='Serve websocket clients from N fan-out worker processes sharing the port, for large audiences. Default is 0 (serve them from this process).')
+    parser.add_argument('--log', type=str, metavar='CATEGORY,...',
+                        help=f"Log categories to print, or 'all' or 'none': {', '.join(log.CATEGORIES)}. "
+                             f"Default is {','.join(name for name, c in log.CATEGORIES.items() if c.on)}.")
     parser.add_argument('--list-devices', action='store_true',
                         help='List audio input devices and exit')
     args = parser.parse_args()
 
+    if args.log is not None:
+        try:
+            log.configure(args.log.split(','))
+        except ValueError as e:
+            parser.error(str(e))
+
     if args.list_devices:
         import sounddevice as sd
         for i, dev in enumerate(sd.query_devices()):
@@ -529,27 +619,52 @@ async def main():
             print(f"  [{i}] {dev['name']}  ({', '.join(dirs)})")
         return
 
-    args_count = sum(x is not None for x in [args.fake, args.device, args.rtmidi, args.audio])
-    if args_count != 1:
-        print('Error: must specify exactly one of --fake, --device, --rtmidi, or --audio')
+    args_count = sum(x is not None for x in [args.fake, args.device, args.rtmidi, args.audio, args.relay, args.apc40,
+                                             args.replay])
+    if args_count + args.mouse == 0:
+        print('Error: must specify at least one of --fake, --device, --rtmidi, --audio, --relay, --apc40, --replay, or --mouse')
         exit(1)
 
+    capture = None
+    if args.capture:
+        capture = MidiCapture(args.capture)
+        atexit.register(capture.close)
+
     # Restart-on-error loop (only exits on KeyboardInterrupt)
     while True:
         #try:
-        async with websockets.serve(handler, "0.0.0.0", WS_PORT), \
-                asyncio.TaskGroup() as tg:
+        if args.workers:
+            server = serve_workers(args.workers, args.port)
+        else:
+            server = websockets.serve(handler, "0.0.0.0", args.port, subprotocols=SUBPROTOCOLS,
+                    process_request=stats_endpoint(connected),
+                    write_limit=SEND_BUFFER_HIGH)
+        async with server, asyncio.TaskGroup() as tg:
             queue = asyncio.Queue()
+            knobs = KnobCoalescer(connected, args.knob_rate)
+            tg.create_task(knobs.run())
+            # Input sources: each runs as its own task, feeding `connected`
+            # (or the knob coalescer) directly.
             if args.rtmidi:
-                t1 = tg.create_task(main_loop_rtmidi(args.rtmidi))
-            elif args.device:
-                t1 = tg.create_task(main_loop_serial(args.device, queue, cycle=args.cycle))
-            elif args.audio is not None:
-                t1 = tg.create_task(main_loop_audio(args.audio))
-            else:
-                t1 = tg.create_task(main_loop_fake(args.fake, cycle=args.cycle))
+                tg.create_task(main_loop_rtmidi(args.rtmidi, queue, knobs, cycle=args.cycle, capture=capture))
+            if args.device:
+                tg.create_task(main_loop_serial(args.device, queue, knobs, cycle=args.cycle, capture=capture))
+            if args.replay:
+                tg.create_task(main_loop_replay(args.replay, args.speed, queue, knobs, cycle=args.cycle))
+            if args.audio is not None:
+                tg.create_task(main_loop_audio(args.audio))
+            if args.relay:
+                tg.create_task(relay_loop(args.relay, connected))
+            if args.fake is not None:
+                tg.create_task(main_loop_fake(args.fake, cycle=args.cycle))
                 if FAKE_KNOB_MOVEMENT:
-                    t_knobs = tg.create_task(main_loop_FAKE_KNOB_MOVEMENT(args.fake))
+                    tg.create_task(main_loop_FAKE_KNOB_MOVEMENT(args.fake, knobs))
+            if args.apc40:
+                tg.create_task(main_loop_apc40(args.apc40, knobs))
+            if args.mouse:
+                # Only importable on macOS.
+                from mouse_control import main_loop_mouse
+                tg.create_task(main_loop_mouse(knobs))
 
             if USE_LEDS:
                 t2 = tg.create_task(led_update_loop())
@@ -1,18 +1,13 @@
-import argparse
+"""Akai APC40 mkII input source for the adapter hub (`adapter.py --apc40`):
+track faders and top knobs become normalized knob updates."""
 import asyncio
-import json
-import time
 
-import websockets
 from rtmidi.midiutil import open_midiinput
 from rtmidi import midiconstants
 
+import log
 from message import MsgControlChange
 
-# Same websocket port adapter.py serves on, so the web client connects here
-# unchanged (it just won't get any sync/beat traffic from this script).
-WS_PORT = 8766
-
 # Default substring used to find the APC40 mkII input port. open_midiinput
 # matches this against the available port names.
 DEFAULT_PORT = "APC40"
@@ -35,45 +30,24 @@ KNOB_COUNT = 8
 KNOB_WHEEL_BASE = 8
 
 
-# Connected viewer clients (mirrors adapter.py / control.py).
-connected = set()
-
-# Last message's roundtrip latency divided by two, in seconds. Updated from the
-# ack messages clients send back.
-last_msg_latency = 0.0
-
-
-async def handler(websocket):
-    global last_msg_latency
-    connected.add(websocket)
-    print("Client connected")
-    try:
-        async for message in websocket:
-            msg = json.loads(message)
-            last_msg_latency = (time.time() - msg['t']) / 2
-    finally:
-        connected.remove(websocket)
-        print("Client disconnected")
-
-
 class Apc40FaderHandler:
     """rtmidi callback: turn track-fader control-change events into normalized
-    MsgControlChange broadcasts. Invoked on rtmidi's own thread, so it hands the
-    actual broadcast back to the event loop via call_soon_threadsafe."""
+    MsgControlChange updates for the knob coalescer. Invoked on rtmidi's own
+    thread, so it hands each update back to the event loop via
+    call_soon_threadsafe."""
 
-    def __init__(self, loop):
+    def __init__(self, loop, knobs):
         self.loop = loop
+        self.knobs = knobs
 
     def __call__(self, event, data=None):
         message, _deltatime = event
+        log.apc40('APC40: %s', message)
         ws_msg = self.translate(message)
         if ws_msg is not None:
-            print(ws_msg)
-            self.loop.call_soon_threadsafe(
-                websockets.broadcast, connected, ws_msg.to_json())
+            self.loop.call_soon_threadsafe(self.knobs.add, ws_msg)
 
     def translate(self, midi_msg):
-        print(midi_msg)
         status, control_idx, control_val = midi_msg
         channel = status & 0x0F
         if (status & 0xF0) != midiconstants.CONTROL_CHANGE:
@@ -89,30 +63,17 @@ class Apc40FaderHandler:
 
         if wheel_idx is None:
             return None
-        return MsgControlChange(
-            last_msg_latency, wheel_idx, control_val / MIDI_CC_MAX)
-
+        return MsgControlChange(0, wheel_idx, control_val / MIDI_CC_MAX)
 
-async def main():
-    parser = argparse.ArgumentParser(
-        description="Akai APC40 mkII faders -> web control-change adapter")
-    parser.add_argument('-p', '--port', type=str, default=DEFAULT_PORT,
-                        help=f'MIDI input port name/substring (default {DEFAULT_PORT})')
-    args = parser.parse_args()
 
-    midiin, port_name = open_midiinput(args.port)
+async def main_loop_apc40(port, knobs):
+    """Feed the faders and top knobs of the APC40 on MIDI input `port` (a
+    port name substring) to the knob coalescer `knobs`, until cancelled."""
+    midiin, port_name = open_midiinput(port)
     try:
-        loop = asyncio.get_running_loop()
-        midiin.set_callback(Apc40FaderHandler(loop))
-        async with websockets.serve(handler, "0.0.0.0", WS_PORT):
-            print(f'Serving on ws://0.0.0.0:{WS_PORT} '
-                  f'(APC40 "{port_name}" faders -> knobs 0-7, '
-                  f'top knobs -> knobs 8-15)')
-            await asyncio.Future()  # run forever
+        midiin.set_callback(Apc40FaderHandler(asyncio.get_running_loop(), knobs))
+        print(f'APC40 "{port_name}": faders -> knobs 0-7, top knobs -> knobs 8-15')
+        await asyncio.Event().wait()  # run until cancelled
     finally:
         midiin.close_port()
         del midiin
-
-
-if __name__ == "__main__":
-    asyncio.run(main())
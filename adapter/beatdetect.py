@@ -79,8 +79,10 @@ class MinimalDetector:
 
         self.running = False
 
-    def _process_block(self, mono_block, timeinfo):
-        now = timeinfo.inputBufferAdcTime
+    def _process_block(self, mono_block, block_t):
+        """`block_t` is when the block's first sample was captured, on the
+        time.monotonic() clock."""
+        now = block_t
 
         # Accumulate into FFT buffer
         n = len(mono_block)
@@ -123,9 +125,9 @@ class MinimalDetector:
             self.snare_energy_avg = np.mean(self.snare_energy_history)
         snare_spike = snare_energy / max(self.snare_energy_avg, 1e-6)
 
-        # Estimated latency: beat onset is somewhere in the most recent block,
-        # so latency is at most one block period.
-        latency_s = BLOCK_SIZE / SAMPLE_RATE
+        # Beat onset is somewhere in this block; measure latency from its start,
+        # so the time spent in driver buffers and this FFT is included.
+        latency_s = time.monotonic() - block_t
 
         if kick_spike > KICK_SPIKE_THRESHOLD and kick_energy > KICK_ENERGY_MIN and (now - self.last_kick_time) > self.cooldown_s:
             self.last_kick_time = now
@@ -137,7 +139,18 @@ class MinimalDetector:
 
     def _audio_callback(self, indata, frames, time_info, status):
         mono = indata[:, 0] if indata.ndim > 1 else indata.flatten()
-        self._process_block(mono, time_info)
+        self._process_block(mono, self._adc_time(time_info, frames))
+
+    @staticmethod
+    def _adc_time(time_info, frames):
+        """When the block's first sample hit the ADC, on the time.monotonic()
+        clock. PortAudio's times are on the stream's own clock, offset to ours
+        by way of currentTime, the stream time at which the callback began."""
+        now = time.monotonic()
+        if time_info.currentTime and time_info.inputBufferAdcTime:
+            return now - (time_info.currentTime - time_info.inputBufferAdcTime)
+        # Some host APIs report no times: assume the block just filled.
+        return now - frames / SAMPLE_RATE
 
     def run_mic(self, device=None):
         self.running = True
@@ -222,7 +235,7 @@ class MinimalDetector:
                 block = mono[pos:end]
                 if len(block) < BLOCK_SIZE:
                     block = np.pad(block, (0, BLOCK_SIZE - len(block)))
-                self._process_block(block)
+                self._process_block(block, time.monotonic() - block_dur)
                 pos = end
                 time.sleep(block_dur)
 
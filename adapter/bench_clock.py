@@ -0,0 +1,124 @@
+"""Benchmark: MIDI clock recovery (ClockTracker) on synthetic clocks.
+
+Feeds ClockTracker, and for comparison the tracker it replaced (a rate from
+the first and last of the last 384 tick times, summing them all on every
+tick), a clock with Gaussian arrival jitter that changes tempo halfway
+through. Reports the time per tick, the error of the tempo estimate, the
+error of the phase (the tick time stamped on syncs, which for the old
+tracker was the raw arrival time) and how many ticks each took to settle on
+the new tempo.
+"""
+import argparse
+from collections import deque
+import math
+import random
+import time
+
+from clock import ClockTracker
+
+PPQN = 24
+
+# Tempo estimates within this of the true tempo count as settled.
+SETTLED_BPM = 0.5
+
+
+class EndpointClockTracker:
+    """The previous ClockTracker's estimate, kept here for comparison."""
+
+    def __init__(self):
+        self.sync_rate_hz = 120 / 60 * 24
+        self.tick_t = None
+        self._samples = deque()
+
+    def ping(self, t):
+        self.tick_t = t
+        self._samples.append(t)
+        while len(self._samples) > 16 * 24:
+            self._samples.popleft()
+        if len(self._samples) >= 4 * 24 and sum(self._samples) > 0:
+            self.sync_rate_hz = (len(self._samples) - 1) / (self._samples[-1] - self._samples[0])
+
+
+def make_ticks(segments, jitter_s, seed=0, start_t=1.7e9):
+    """Arrival times and true times of the ticks of a clock playing each
+    (bpm, beats) segment in turn, with Gaussian arrival jitter (only ever
+    late) of standard deviation `jitter_s`. Returns (arrivals, true_ts,
+    bpms)."""
+    rng = random.Random(seed)
+    arrivals, true_ts, bpms = [], [], []
+    t = start_t
+    for bpm, beats in segments:
+        period_s = 60 / bpm / PPQN
+        for _ in range(beats * PPQN):
+            true_ts.append(t)
+            arrivals.append(t + abs(rng.gauss(0, jitter_s)))
+            bpms.append(bpm)
+            t += period_s
+    return arrivals, true_ts, bpms
+
+
+def run(tracker, arrivals, true_ts, bpms):
+    """Feed `tracker` the ticks; return (tempo errors in BPM, phase errors in
+    seconds) after each tick."""
+    bpm_errs, phase_errs = [], []
+    for t, true_t, bpm in zip(arrivals, true_ts, bpms):
+        tracker.ping(t)
+        bpm_errs.append(tracker.sync_rate_hz * 60 / PPQN - bpm)
+        phase_errs.append(tracker.tick_t - true_t)
+    return bpm_errs, phase_errs
+
+
+def rms(values):
+    return math.sqrt(sum(v * v for v in values) / len(values))
+
+
+def settle_ticks(bpm_errs, start):
+    """Ticks from `start` until the tempo error stays within SETTLED_BPM."""
+    last_unsettled = start - 1
+    for i in range(start, len(bpm_errs)):
+        if abs(bpm_errs[i]) > SETTLED_BPM:
+            last_unsettled = i
+    return last_unsettled + 1 - start
+
+
+def time_ping(make_tracker, arrivals, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        tracker = make_tracker()
+        for t in arrivals:
+            tracker.ping(t)
+    return (time.perf_counter() - start) / (rounds * len(arrivals))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIDI clock recovery benchmark")
+    parser.add_argument('--bpm', type=float, default=120, help='tempo of the first half (default 120)')
+    parser.add_argument('--new-bpm', type=float, default=126, help='tempo of the second half (default 126)')
+    parser.add_argument('--beats', type=int, default=64, help='beats per half (default 64)')
+    parser.add_argument('--jitter-ms', type=float, default=1.0,
+                        help='standard deviation of arrival jitter (default 1.0)')
+    parser.add_argument('--rounds', type=int, default=20, help='passes for timing (default 20)')
+    args = parser.parse_args()
+
+    arrivals, true_ts, bpms = make_ticks([(args.bpm, args.beats), (args.new_bpm, args.beats)],
+                                         args.jitter_ms / 1e3)
+    change = args.beats * PPQN
+    print(f'{len(arrivals)} ticks, {args.bpm:g} -> {args.new_bpm:g} BPM at tick {change}, '
+          f'{args.jitter_ms:g} ms jitter')
+    for name, make_tracker in (('endpoint', EndpointClockTracker), ('pll', ClockTracker)):
+        bpm_errs, phase_errs = run(make_tracker(), arrivals, true_ts, bpms)
+        settled = settle_ticks(bpm_errs, change)
+        # Steady state: the last quarter of each half.
+        steady = (list(range(change * 3 // 4, change))
+                  + list(range(change + change * 3 // 4, len(arrivals))))
+        # Phase error relative to the mean, as the jitter is one-sided.
+        steady_phase = [phase_errs[i] for i in steady]
+        mean_phase = sum(steady_phase) / len(steady_phase)
+        print(f'  {name:8s} {time_ping(make_tracker, arrivals, args.rounds) * 1e9:7.0f} ns/tick  '
+              f'tempo error {rms([bpm_errs[i] for i in steady]):6.3f} BPM rms  '
+              f'phase jitter {rms([e - mean_phase for e in steady_phase]) * 1e3:6.3f} ms rms  '
+              f'settled in {settled:4d} ticks')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Microbenchmark: cost of encoding one clock tick's worth of messages.
+
+Replays four bars of the fake beat pattern (one MsgSync per tick plus the
+MsgBeats and scene changes the fake source would send) and reports the mean
+encode cost per tick for:
+
+  legacy    json.dumps(msg.__dict__) per broadcast, as before the encode cache
+  json      Msg.encode(False): MsgSync via its pre-built template
+  binary    Msg.encode(True): fixed-layout struct frames
+  both      first encode of each format, as when JSON and binary clients
+            are connected at the same time
+  repeat    every further encode of an already-sent message (cache hit)
+"""
+import argparse
+import json
+import time
+
+from message import *
+
+PATTERN_TICKS = 4 * 4 * 24     # four bars of 24 PPQN ticks
+
+
+def make_ticks(bpm):
+    """One list of fresh messages per tick, shaped like main_loop_fake's."""
+    sync_rate_hz = bpm * 24 / 60
+    ticks = []
+    for sync_idx in range(PATTERN_TICKS):
+        msgs = [MsgSync(0.0012, sync_rate_hz, sync_idx)]
+        if sync_idx % 6 == 0:
+            step = sync_idx // 6
+            msgs.append(MsgBeat(0.0012, 1 if step % 4 == 0 else 9))
+            if step % 2 == 0:
+                msgs.append(MsgBeat(0.0012, 10))
+        if sync_idx % (4 * 24) == 0:
+            msgs.append(MsgGotoScene(0.0012, 7, True))
+        if sync_idx % (4 * 24) == 2 * 24:
+            msgs.append(MsgAdvanceSceneState(0.0012, 1))
+        ticks.append(msgs)
+    return ticks
+
+
+def legacy(msgs):
+    for msg in msgs:
+        json.dumps(msg.__dict__)
+
+
+def encode_json(msgs):
+    for msg in msgs:
+        msg.encode(False)
+
+
+def encode_binary(msgs):
+    for msg in msgs:
+        msg.encode(True)
+
+
+def encode_both(msgs):
+    for msg in msgs:
+        msg.encode(False)
+        msg.encode(True)
+
+
+def time_per_tick(fn, bpm, rounds, warm=False):
+    total = 0.0
+    n = 0
+    for _ in range(rounds):
+        ticks = make_ticks(bpm)
+        if warm:
+            for msgs in ticks:
+                encode_both(msgs)
+        start = time.perf_counter()
+        for msgs in ticks:
+            fn(msgs)
+        total += time.perf_counter() - start
+        n += len(ticks)
+    return total / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-tick message encode benchmark")
+    parser.add_argument('--bpm', type=float, default=160, help='tempo (default 160)')
+    parser.add_argument('--rounds', type=int, default=200, help='four-bar patterns to time (default 200)')
+    args = parser.parse_args()
+
+    # The template must produce the same JSON as json.dumps would.
+    sync = MsgSync(0.0012, args.bpm * 24 / 60, 1234)
+    assert json.loads(sync.to_json()) == json.loads(json.dumps(sync.fields()))
+    assert vars(Msg.from_bytes(sync.to_bytes())).keys() >= sync.fields().keys()
+
+    results = [
+        ('legacy', time_per_tick(legacy, args.bpm, args.rounds)),
+        ('json', time_per_tick(encode_json, args.bpm, args.rounds)),
+        ('binary', time_per_tick(encode_binary, args.bpm, args.rounds)),
+        ('both', time_per_tick(encode_both, args.bpm, args.rounds)),
+        ('repeat', time_per_tick(encode_both, args.bpm, args.rounds, warm=True)),
+    ]
+    ticks_per_s = args.bpm * 24 / 60
+    base = results[0][1]
+    print(f'{ticks_per_s:.0f} ticks/s at {args.bpm:g} BPM')
+    for name, per_tick in results:
+        print(f'  {name:8s} {per_tick * 1e6:7.2f} us/tick  '
+              f'{per_tick * ticks_per_s * 1e3:6.3f} ms/s  '
+              f'{base / per_tick:5.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+"""Benchmark: how many websocket clients can be served at a given p99 latency.
+
+For each worker count, starts a source that broadcasts the fake beat pattern
+(see bench_encode.make_ticks) either from its own process (--workers 0) or
+through fan-out worker processes (see fanout.py), then connects ever more
+binary clients, doubling each step. Clients ACK pings like main.js and record
+each sync's delivery latency (receive time minus its t). Reports the largest
+client count whose p99 latency stayed within --p99-ms.
+
+Clients run in --client-procs processes on this same machine and compete with
+the adapter for CPU, so treat results as relative between worker counts.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import time
+
+import websockets
+
+from bench_encode import make_ticks
+from clients import SEND_BUFFER_HIGH, serve_client
+from fanout import serve_workers
+from message import Msg
+from wire import BINARY_ACK, BINARY_BATCH_HEADER, SUBPROTOCOL_BINARY, SUBPROTOCOLS, Batch
+
+# Latencies from the first WARMUP_S of each step (connection setup) are
+# ignored.
+WARMUP_S = 1.0
+
+
+async def source_main(num_workers, port, bpm):
+    connected = set()
+
+    async def handler(websocket):
+        await serve_client(connected, websocket)
+
+    if num_workers:
+        server = serve_workers(num_workers, port)
+    else:
+        server = websockets.serve(handler, "127.0.0.1", port, subprotocols=SUBPROTOCOLS,
+                                  write_limit=SEND_BUFFER_HIGH)
+    tick_s = 60.0 / (bpm * 24)
+    async with server:
+        next_tick_time = time.time()
+        while True:
+            for msgs in make_ticks(bpm):
+                batch = Batch(connected)
+                for msg in msgs:
+                    msg.t = time.time()
+                    batch.add(msg)
+                batch.flush()
+                next_tick_time += tick_s
+                await asyncio.sleep(max(0, next_tick_time - time.time()))
+
+
+def run_source(num_workers, port, bpm):
+    asyncio.run(source_main(num_workers, port, bpm))
+
+
+async def client_main(port, num_clients, seconds):
+    latencies = []
+    t_end = time.time() + seconds
+    t_measure = time.time() + WARMUP_S
+
+    async def one_client():
+        async with websockets.connect(f'ws://127.0.0.1:{port}',
+                                      subprotocols=[SUBPROTOCOL_BINARY]) as websocket:
+            while time.time() < t_end:
+                try:
+                    frame = await asyncio.wait_for(websocket.recv(), t_end - time.time())
+                except asyncio.TimeoutError:
+                    return
+                now = time.time()
+                _, _, count = BINARY_BATCH_HEADER.unpack_from(frame)
+                msgs, _ = Msg.split_bytes(frame, count, BINARY_BATCH_HEADER.size)
+                for msg in msgs:
+                    if msg.msg_type == Msg.Type.PING:
+                        await websocket.send(BINARY_ACK.pack(Msg.Type.ACK, msg.t, time.time()))
+                    elif msg.msg_type == Msg.Type.SYNC and now >= t_measure:
+                        latencies.append(now - msg.t)
+
+    await asyncio.gather(*[one_client() for _ in range(num_clients)])
+    return latencies
+
+
+def run_clients(port, num_clients, seconds, results):
+    results.put(asyncio.run(client_main(port, num_clients, seconds)))
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def measure(mp, port, num_clients, procs, seconds):
+    """Latencies of every sync delivered to `num_clients` clients."""
+    results = mp.Queue()
+    counts = [num_clients // procs + (i < num_clients % procs) for i in range(procs)]
+    workers = [mp.Process(target=run_clients, args=(port, n, seconds, results))
+               for n in counts if n]
+    for worker in workers:
+        worker.start()
+    latencies = []
+    for _ in workers:
+        latencies += results.get()
+    for worker in workers:
+        worker.join()
+    return sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Max clients at a fixed p99 latency")
+    parser.add_argument('--workers', type=str, default='0,2,4',
+                        help='comma-separated fan-out worker counts to compare (default 0,2,4)')
+    parser.add_argument('--p99-ms', type=float, default=20, help='p99 latency budget (default 20 ms)')
+    parser.add_argument('--bpm', type=float, default=160, help='tempo (default 160)')
+    parser.add_argument('--start', type=int, default=25, help='clients in the first step (default 25)')
+    parser.add_argument('--max', type=int, default=3200, help='stop doubling past this many clients (default 3200)')
+    parser.add_argument('--seconds', type=float, default=5, help='length of each step (default 5)')
+    parser.add_argument('--client-procs', type=int, default=4, help='client processes (default 4)')
+    parser.add_argument('--port', type=int, default=8799, help='websocket port (default 8799)')
+    args = parser.parse_args()
+
+    mp = multiprocessing.get_context('spawn')
+    for num_workers in [int(n) for n in args.workers.split(',')]:
+        # Not a daemon: it has to start worker processes of its own. Workers
+        # exit by themselves once the source is gone.
+        source = mp.Process(target=run_source, args=(num_workers, args.port, args.bpm))
+        source.start()
+        time.sleep(1.0 + 0.5 * num_workers)
+        best = 0
+        num_clients = args.start
+        print(f'{num_workers} workers:')
+        while num_clients <= args.max:
+            latencies = measure(mp, args.port, num_clients, args.client_procs, args.seconds)
+            if not latencies:
+                print(f'  {num_clients:5d} clients  no syncs received')
+                break
+            p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+            print(f'  {num_clients:5d} clients  p50 {p50 * 1e3:7.2f} ms  p99 {p99 * 1e3:7.2f} ms')
+            if p99 * 1e3 > args.p99_ms:
+                break
+            best = num_clients
+            num_clients *= 2
+        print(f'  max clients at p99 <= {args.p99_ms:g} ms: {best}')
+        source.terminate()
+        source.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""Load test: how the adapter's broadcast path holds up with N viewers.
+
+Starts `adapter.py --fake` (with any further adapter options given), then for
+each client count connects that many simulated viewers, spread over
+--client-procs processes. Like main.js they subscribe to one sync in
+--sync-every and ACK pings. Each step reports the messages and bytes
+delivered per second across all clients, the adapter's CPU use (its worker
+processes included), the delivery latency of every message (receive time
+minus its `t`) at p50, p99 and p99.9, and how many clients were
+disconnected. Messages in the first WARMUP_S after a client connects,
+including the state snapshot, don't count.
+
+Results also go to a JSON file (--out), with the commit they were measured
+on, so changes to the broadcast path can be compared over time. Clients run
+on the same machine and compete with the adapter for CPU, so compare
+results from the same machine only.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import pathlib
+import socket
+import subprocess
+import sys
+import time
+
+import websockets
+
+from message import Msg
+from wire import (BINARY_ACK, BINARY_BATCH_HEADER, BINARY_SUBSCRIBE, SUBPROTOCOL_BINARY,
+                  SUBPROTOCOL_JSON, SUBSCRIBE_ALL)
+
+# Messages in each client's first WARMUP_S are not counted.
+WARMUP_S = 1.0
+
+# How long to wait for the adapter to start listening.
+START_TIMEOUT_S = 10.0
+
+ADAPTER = pathlib.Path(__file__).with_name('adapter.py')
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+def process_tree_cpu_s(pid):
+    """CPU seconds used so far by process `pid` and its descendants, from
+    /proc; None where there is no /proc."""
+    ticks = os.sysconf('SC_CLK_TCK')
+    stats = {}
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    # Fields after the command name, which may contain spaces.
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            # ppid, utime and stime are fields 4, 14 and 15 of stat.
+            stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    except OSError:
+        return None
+    total, pids = 0, {pid}
+    while pids:
+        total += sum(stats[p][1] for p in pids if p in stats)
+        pids = {p for p, (ppid, _) in stats.items() if ppid in pids}
+    return total / ticks
+
+
+async def one_client(port, binary, sync_every, t_end):
+    """Listen until `t_end`, ACKing pings. Returns (messages, bytes,
+    latencies, seconds counted, whether it stayed connected)."""
+    num_msgs = num_bytes = 0
+    latencies = []
+    subprotocol = SUBPROTOCOL_BINARY if binary else SUBPROTOCOL_JSON
+    try:
+        async with websockets.connect(f'ws://127.0.0.1:{port}', subprotocols=[subprotocol],
+                                      max_queue=None) as websocket:
+            t_measure = time.time() + WARMUP_S
+            if binary:
+                await websocket.send(BINARY_SUBSCRIBE.pack(Msg.Type.SUBSCRIBE, SUBSCRIBE_ALL,
+                                                           SUBSCRIBE_ALL, sync_every))
+            else:
+                await websocket.send(json.dumps({'msg_type': Msg.Type.SUBSCRIBE,
+                                                 'sync_every': sync_every}))
+            while time.time() < t_end:
+                try:
+                    frame = await asyncio.wait_for(websocket.recv(), t_end - time.time())
+                except asyncio.TimeoutError:
+                    break
+                now = time.time()
+                # Messages with no binary layout come as JSON even to binary
+                # clients.
+                if isinstance(frame, bytes):
+                    _, _, count = BINARY_BATCH_HEADER.unpack_from(frame)
+                    msgs, _ = Msg.split_bytes(frame, count, BINARY_BATCH_HEADER.size)
+                    stamps = [(msg.msg_type, msg.t) for msg in msgs]
+                else:
+                    stamps = [(msg['msg_type'], msg['t']) for msg in json.loads(frame)['msgs']]
+                for msg_type, t in stamps:
+                    if msg_type == Msg.Type.PING:
+                        if binary:
+                            await websocket.send(BINARY_ACK.pack(Msg.Type.ACK, t, time.time()))
+                        else:
+                            await websocket.send(json.dumps({'msg_type': Msg.Type.ACK, 't': t,
+                                                             't_client': time.time()}))
+                if now >= t_measure:
+                    num_msgs += len(stamps)
+                    num_bytes += len(frame)
+                    latencies += [now - t for _, t in stamps]
+            counted_s = max(0.0, min(time.time(), t_end) - t_measure)
+            return num_msgs, num_bytes, latencies, counted_s, True
+    except (OSError, websockets.ConnectionClosed):
+        return num_msgs, num_bytes, latencies, 0.0, False
+
+
+async def client_main(port, num_clients, binary, sync_every, seconds):
+    t_end = time.time() + seconds
+    return await asyncio.gather(*[one_client(port, binary, sync_every, t_end)
+                                  for _ in range(num_clients)])
+
+
+def run_clients(port, num_clients, binary, sync_every, seconds, results):
+    results.put(asyncio.run(client_main(port, num_clients, binary, sync_every, seconds)))
+
+
+def measure(mp, adapter_pid, port, num_clients, args):
+    """One step with `num_clients` clients: their results put together."""
+    results = mp.Queue()
+    counts = [num_clients // args.client_procs + (i < num_clients % args.client_procs)
+              for i in range(args.client_procs)]
+    procs = [mp.Process(target=run_clients,
+                        args=(port, n, args.protocol == 'bin', args.sync_every, args.seconds, results))
+             for n in counts if n]
+    start = time.time()
+    for proc in procs:
+        proc.start()
+    # CPU is counted over the same part of the step as the messages.
+    time.sleep(WARMUP_S)
+    cpu_start, cpu_start_t = process_tree_cpu_s(adapter_pid), time.time()
+    clients = []
+    for _ in procs:
+        clients += results.get()
+    cpu_end, cpu_end_t = process_tree_cpu_s(adapter_pid), time.time()
+    for proc in procs:
+        proc.join()
+
+    latencies = sorted(lat for client in clients for lat in client[2])
+    step = {
+        'clients': num_clients,
+        'seconds': time.time() - start,
+        'dropped': sum(1 for client in clients if not client[4]),
+        'msgs_per_s': sum(n / s for n, _, _, s, _ in clients if s > 0),
+        'bytes_per_s': sum(b / s for _, b, _, s, _ in clients if s > 0),
+        'server_cpu': (None if cpu_start is None or cpu_end is None
+                       else (cpu_end - cpu_start) / (cpu_end_t - cpu_start_t)),
+        'latency_ms': None,
+    }
+    if latencies:
+        step['latency_ms'] = {
+            'count': len(latencies),
+            'p50': percentile(latencies, 0.5) * 1e3,
+            'p99': percentile(latencies, 0.99) * 1e3,
+            'p999': percentile(latencies, 0.999) * 1e3,
+            'max': latencies[-1] * 1e3,
+        }
+    return step
+
+
+def wait_for_port(port, proc):
+    t_end = time.time() + START_TIMEOUT_S
+    while time.time() < t_end and proc.poll() is None:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return True
+        except OSError:
+            time.sleep(0.1)
+    return False
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ADAPTER.parent, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_step(step):
+    line = (f'  {step["clients"]:5d} clients  {step["msgs_per_s"]:9.0f} msgs/s  '
+            f'{step["bytes_per_s"] / 1e3:9.1f} kB/s')
+    if step['server_cpu'] is not None:
+        line += f'  cpu {step["server_cpu"] * 100:5.1f}%'
+    latency = step['latency_ms']
+    if latency:
+        line += (f'  latency p50 {latency["p50"]:7.2f}  p99 {latency["p99"]:7.2f}  '
+                 f'p99.9 {latency["p999"]:7.2f} ms')
+    else:
+        line += '  no messages received'
+    if step['dropped']:
+        line += f'  {step["dropped"]} dropped'
+    return line
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Adapter fan-out load test",
+                                     epilog='Arguments after -- are passed on to adapter.py, '
+                                            'e.g. -- --workers 2 --cycle 1')
+    parser.add_argument('--clients', type=int, nargs='+', default=[10, 50, 200],
+                        help='client counts to step through (default 10 50 200)')
+    parser.add_argument('--client-procs', type=int, default=4, help='client processes (default 4)')
+    parser.add_argument('--seconds', type=float, default=10, help='length of each step (default 10)')
+    parser.add_argument('--bpm', type=float, default=160, help='tempo of the fake source (default 160)')
+    parser.add_argument('--protocol', choices=('bin', 'json'), default='bin',
+                        help='subprotocol the clients use (default bin)')
+    parser.add_argument('--sync-every', type=int, default=24,
+                        help='syncs each client subscribes to, one in N (default 24, as main.js)')
+    parser.add_argument('--port', type=int, default=8798, help='websocket port (default 8798)')
+    parser.add_argument('--out', type=str, default='bench_load.json',
+                        help='JSON file to write results to (default bench_load.json)')
+    args, adapter_args = parser.parse_known_args()
+    if adapter_args and adapter_args[0] == '--':
+        adapter_args = adapter_args[1:]
+
+    # Its errors still show, on stderr.
+    adapter = subprocess.Popen([sys.executable, str(ADAPTER), '--fake', str(args.bpm),
+                                '--port', str(args.port), '--log', 'none'] + adapter_args,
+                               stdout=subprocess.DEVNULL)
+    steps = []
+    try:
+        if not wait_for_port(args.port, adapter):
+            print(f'adapter.py did not start listening on port {args.port}')
+            sys.exit(1)
+        # Let the fake clock settle and any worker processes start.
+        time.sleep(1.0)
+        print(f'adapter.py {" ".join(["--fake", f"{args.bpm:g}"] + adapter_args)}: '
+              f'{args.protocol} clients, sync_every {args.sync_every}, {args.seconds:g} s steps')
+        mp = multiprocessing.get_context('spawn')
+        for num_clients in args.clients:
+            step = measure(mp, adapter.pid, args.port, num_clients, args)
+            print(format_step(step))
+            steps.append(step)
+    finally:
+        adapter.terminate()
+        adapter.wait()
+
+    result = {
+        'time': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'args': vars(args),
+        'adapter_args': adapter_args,
+        'steps': steps,
+    }
+    with open(args.out, 'w') as f:
+        json.dump(result, f, indent=1)
+        f.write('\n')
+    print(f'Results written to {args.out}')
+
+
+if __name__ == "__main__":
+    main()
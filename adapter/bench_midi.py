@@ -0,0 +1,70 @@
+"""Benchmark: MIDI stream parsing throughput.
+
+Parses a byte stream, by default a synthetic four-bar recording shaped like a
+drum machine's output (24 PPQN clock, notes using running status, CC sweeps,
+clock bytes landing inside other messages), or a raw capture given with
+--file. Reports throughput of MidiParser.feed() when fed:
+
+  bytewise  one byte per call, as the old one-byte serial reads did
+  chunk N   N bytes per call, as chunked serial reads deliver them
+"""
+import argparse
+import time
+
+from midi import MidiParser
+
+CHUNK_SIZES = (16, 64, 256)
+
+
+def make_stream(bars):
+    out = bytearray()
+    for sync_idx in range(bars * 4 * 24):
+        out.append(0xF8)
+        if sync_idx % 6 == 0:
+            # Kick/hat note-ons on channel 10, the second with running status;
+            # a clock byte lands in the middle of the first.
+            out += bytes([0x99, 36, 0xF8, 100, 42, 90])
+        if sync_idx % 3 == 0:
+            # A knob sweep: one CC with running status for the second value.
+            value = (sync_idx * 5) % 128
+            out += bytes([0xB0, 1, value, 2, 127 - value])
+        if sync_idx % 24 == 12:
+            out += bytes([0x89, 36, 0])
+    return bytes(out)
+
+
+def time_feed(stream, chunk_size, rounds):
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    num_msgs = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        parser = MidiParser()
+        for chunk in chunks:
+            num_msgs += len(parser.feed(chunk))
+    return time.perf_counter() - start, num_msgs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIDI stream parser throughput benchmark")
+    parser.add_argument('--file', type=str, help='raw MIDI byte capture to parse (default: synthetic)')
+    parser.add_argument('--bars', type=int, default=64, help='length of the synthetic stream (default 64)')
+    parser.add_argument('--rounds', type=int, default=20, help='passes over the stream (default 20)')
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, 'rb') as f:
+            stream = f.read()
+    else:
+        stream = make_stream(args.bars)
+
+    total_bytes = len(stream) * args.rounds
+    print(f'{len(stream)} bytes x {args.rounds} rounds')
+    for name, chunk_size in [('bytewise', 1)] + [(f'chunk {n}', n) for n in CHUNK_SIZES]:
+        elapsed, num_msgs = time_feed(stream, chunk_size, args.rounds)
+        print(f'  {name:9s} {total_bytes / elapsed / 1e6:6.2f} MB/s  '
+              f'{num_msgs / elapsed / 1e6:5.2f} M msgs/s  '
+              f'{elapsed / total_bytes * 1e9:6.1f} ns/byte')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Benchmark: jitter of a generated clock, asyncio.sleep() against Ticker.
+
+Runs a clock at the fake source's sync rate both ways, each time with the
+event loop kept busy by stand-ins for fan-out: tasks that each take a burst
+of CPU, as broadcasting a batch to a client does, then yield. Reports, in
+milliseconds, how late each tick ran and the inter-tick jitter (how far
+each interval between ticks strayed from the period), as p50, p99 and
+p99.9, and for Ticker how late its thread woke. A tick handed to the loop
+still waits behind whatever is ready to run there, but the messages it
+sends are stamped with its deadline, which is where the thread's timing
+shows.
+"""
+import argparse
+import asyncio
+import time
+
+import ticker as ticker_module
+from ticker import Ticker, percentiles
+
+
+async def busy(burst_s):
+    """Keep the loop busy with bursts of `burst_s` of CPU."""
+    while True:
+        end = time.perf_counter() + burst_s
+        while time.perf_counter() < end:
+            pass
+        await asyncio.sleep(0)
+
+
+async def sleep_clock(period_s, ticks):
+    """The old fake clock loop; returns the times its ticks ran and were due,
+    and None for the wake lateness."""
+    start = time.time()
+    ran, due = [], []
+    for i in range(ticks):
+        due.append(start + i * period_s)
+        ran.append(time.time())
+        await asyncio.sleep(max(0, start + (i + 1) * period_s - time.time()))
+    return ran, due, None
+
+
+async def ticker_clock(period_s, ticks):
+    ran, due = [], []
+    done = asyncio.get_running_loop().create_future()
+    def on_tick(deadline):
+        ran.append(time.time())
+        due.append(deadline)
+        if len(ran) == ticks and not done.done():
+            done.set_result(None)
+    ticker = Ticker('bench', on_tick)
+    ticker.arm(time.time(), period_s)
+    task = asyncio.create_task(ticker.run())
+    await done
+    task.cancel()
+    return ran, due, ticker.stats()['wake_late']
+
+
+async def measure(clock, period_s, ticks, load, burst_s):
+    loaders = [asyncio.create_task(busy(burst_s)) for _ in range(load)]
+    try:
+        ran, due, wake = await clock(period_s, ticks)
+    finally:
+        for task in loaders:
+            task.cancel()
+    late = [r - d for r, d in zip(ran, due)]
+    jitter = [abs(b - a) for a, b in zip(late, late[1:])]
+    return percentiles(late), percentiles(jitter), wake
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generated clock jitter benchmark")
+    parser.add_argument('--bpm', type=float, default=160, help='tempo of the clock (default 160)')
+    parser.add_argument('--ticks', type=int, default=1000, help='ticks per run (default 1000)')
+    parser.add_argument('--load', type=int, nargs='+', default=[0, 4, 16],
+                        help='numbers of busy tasks to run alongside (default 0 4 16)')
+    parser.add_argument('--burst-ms', type=float, default=0.5,
+                        help='CPU each busy task takes before yielding (default 0.5)')
+    parser.add_argument('--switch-interval-ms', type=float,
+                        help="lower the interpreter's switch interval to this while the Ticker runs "
+                             "(see TICKER_SWITCH_INTERVAL_S; default leaves it alone)")
+    args = parser.parse_args()
+    if args.switch_interval_ms is not None:
+        ticker_module.TICKER_SWITCH_INTERVAL_S = args.switch_interval_ms / 1e3
+
+    period_s = 60 / args.bpm / 24
+    print(f'{args.ticks} ticks at {1 / period_s:.1f} Hz, busy tasks of {args.burst_ms:g} ms bursts')
+    for load in args.load:
+        for name, clock in (('sleep', sleep_clock), ('ticker', ticker_clock)):
+            late, jitter, wake = asyncio.run(measure(clock, period_s, args.ticks, load,
+                                                     args.burst_ms / 1e3))
+            fmt = lambda ps: '  '.join(f'{p * 1e3:6.3f}' for p in ps)
+            print(f'  load {load:3d}  {name:6s}  late p50/p99/p99.9 {fmt(late)} ms  '
+                  f'jitter {fmt(jitter)} ms' + (f'  woke {fmt(wake)} ms' if wake else ''))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Recording the raw MIDI input stream to a file, for replaying it later
+(`adapter.py --capture FILE`, `adapter.py --replay FILE`).
+
+A capture file is CAPTURE_MAGIC followed by one record per serial read or
+rtmidi message: a CAPTURE_RECORD header of the time it arrived, in seconds
+on the time.monotonic() clock since the capture began, and its length,
+followed by the bytes themselves.
+"""
+import struct
+import time
+
+CAPTURE_MAGIC = b'VSMIDI1\n'
+CAPTURE_RECORD = struct.Struct('<dH')
+
+# Capture writes go through a buffer this big, so the input loops only pay
+# for a memory copy on most of them.
+CAPTURE_BUFFER_SIZE = 1 << 16
+
+
+class MidiCapture:
+    def __init__(self, path):
+        self.file = open(path, 'wb', buffering=CAPTURE_BUFFER_SIZE)
+        self.file.write(CAPTURE_MAGIC)
+        self.start = time.monotonic()
+        self.records = 0
+
+    def write(self, buf, t=None):
+        """Record `buf`, which arrived at `t` on the time.time() clock
+        (default now)."""
+        now = time.monotonic()
+        if t is not None:
+            now -= time.time() - t
+        self.file.write(CAPTURE_RECORD.pack(now - self.start, len(buf)))
+        self.file.write(bytes(buf))
+        self.records += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_capture(path):
+    """Return the (time, bytes) records of a capture file."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(CAPTURE_MAGIC):
+        raise ValueError(f'{path} is not a MIDI capture file')
+    records = []
+    offset = len(CAPTURE_MAGIC)
+    while offset + CAPTURE_RECORD.size <= len(data):
+        t, length = CAPTURE_RECORD.unpack_from(data, offset)
+        offset += CAPTURE_RECORD.size
+        records.append((t, data[offset:offset + length]))
+        offset += length
+    return records
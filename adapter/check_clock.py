@@ -0,0 +1,124 @@
+"""Jitter rejection check for ClockTracker, on synthetic clocks.
+
+Checks that, at 1 ms of arrival jitter, the tempo estimate is steady and
+the smoothed tick times have a fraction of the raw arrivals' jitter; that a
+late byte now and then isn't mistaken for a tempo change; and that a real
+tempo change is followed within two beats; that with the flywheel running, a
+tick late by more than half a period neither moves the tempo nor the tick
+count; and that through a dropout of the clock the flywheel keeps the tick
+count, and the phase settles again within two beats of it returning. Exits
+non-zero if not.
+"""
+import sys
+
+from bench_clock import PPQN, make_ticks, rms, run, settle_ticks
+from clock import ClockTracker
+
+JITTER_S = 0.001
+
+# Limits, in steady state.
+MAX_BPM_ERROR = 0.05
+MAX_PHASE_JITTER_FRACTION = 0.25
+
+# Late bytes: one tick this late every LATE_EVERY_BEATS beats.
+LATE_S = 0.010
+LATE_EVERY_BEATS = 4
+
+MAX_SETTLE_TICKS = 2 * PPQN
+
+# Flywheel late tick: one tick this late, at each (bpm, late) here.
+FLYWHEEL_LATE = [(160, 0.010), (120, 0.012)]
+
+DROPOUT_BEATS = 3
+
+
+def run_flywheel(tracker, arrivals):
+    """Feed `tracker` the ticks, coasting over each one overdue before the
+    next arrives as adapter.run_flywheel would; yield the index of each tick
+    after it is fed."""
+    for i, t in enumerate(arrivals):
+        while tracker.coast_due_t() is not None and tracker.coast_due_t() < t:
+            tracker.coast(tracker.coast_due_t())
+        tracker.ping(t)
+        yield i
+
+
+def steady_jitter():
+    arrivals, true_ts, bpms = make_ticks([(120, 500)], JITTER_S)
+    tracker = ClockTracker()
+    bpm_errs, phase_errs = run(tracker, arrivals, true_ts, bpms)
+    steady = slice(len(arrivals) // 2, None)
+    arrival_errs = [a - t for a, t in zip(arrivals[steady], true_ts[steady])]
+    mean_arrival = sum(arrival_errs) / len(arrival_errs)
+    mean_phase = sum(phase_errs[steady]) / len(phase_errs[steady])
+    bpm_error = rms(bpm_errs[steady])
+    phase_fraction = (rms([e - mean_phase for e in phase_errs[steady]])
+                      / rms([e - mean_arrival for e in arrival_errs]))
+    print(f'steady 120 BPM, {JITTER_S * 1e3:g} ms jitter: tempo error {bpm_error:.4f} BPM rms, '
+          f'phase jitter {phase_fraction:.2f} of arrival jitter, {tracker.relocks} relocks')
+    return (bpm_error <= MAX_BPM_ERROR and phase_fraction <= MAX_PHASE_JITTER_FRACTION
+            and tracker.relocks == 0)
+
+
+def late_bytes():
+    arrivals, true_ts, bpms = make_ticks([(120, 500)], JITTER_S)
+    for i in range(LATE_EVERY_BEATS * PPQN, len(arrivals), LATE_EVERY_BEATS * PPQN):
+        arrivals[i] += LATE_S
+    tracker = ClockTracker()
+    bpm_errs, _ = run(tracker, arrivals, true_ts, bpms)
+    bpm_error = max(abs(e) for e in bpm_errs[len(arrivals) // 2:])
+    print(f'a tick {LATE_S * 1e3:g} ms late every {LATE_EVERY_BEATS} beats: '
+          f'tempo error {bpm_error:.4f} BPM max, {tracker.relocks} relocks')
+    return bpm_error <= 2 * MAX_BPM_ERROR and tracker.relocks == 0
+
+
+def tempo_change(bpm, new_bpm):
+    arrivals, true_ts, bpms = make_ticks([(bpm, 64), (new_bpm, 16)], JITTER_S)
+    bpm_errs, _ = run(ClockTracker(), arrivals, true_ts, bpms)
+    settled = settle_ticks(bpm_errs, 64 * PPQN)
+    print(f'{bpm:g} -> {new_bpm:g} BPM: settled in {settled} ticks')
+    return settled <= MAX_SETTLE_TICKS
+
+
+def flywheel_late(bpm, late_s):
+    """One tick `late_s` late, with the flywheel watching for dropouts."""
+    arrivals, true_ts, bpms = make_ticks([(bpm, 250)], JITTER_S)
+    arrivals[len(arrivals) // 2] += late_s
+    tracker = ClockTracker()
+    for _ in run_flywheel(tracker, arrivals):
+        pass
+    bpm_error = tracker.sync_rate_hz * 60 / PPQN - bpm
+    print(f'{bpm:g} BPM, flywheel running, a tick {late_s * 1e3:g} ms late: tempo error '
+          f'{bpm_error:.4f} BPM, sync index {tracker.cur_sync_idx} (expected {len(arrivals) - 1}), '
+          f'coasted {tracker.coasted} ticks')
+    return abs(bpm_error) <= MAX_BPM_ERROR and tracker.cur_sync_idx == len(arrivals) - 1
+
+
+def dropout():
+    """Drop the ticks of DROPOUT_BEATS beats, coasting over them as
+    adapter.run_flywheel would, and see that the sync index carries on."""
+    arrivals, true_ts, _ = make_ticks([(120, 32)], JITTER_S)
+    start, end = 16 * PPQN, (16 + DROPOUT_BEATS) * PPQN
+    kept = [i for i in range(len(arrivals)) if not start <= i < end]
+    tracker = ClockTracker()
+    phase_errs = []
+    for j in run_flywheel(tracker, [arrivals[i] for i in kept]):
+        phase_errs.append((kept[j], tracker.tick_t - true_ts[kept[j]]))
+    idx_ok = tracker.cur_sync_idx == len(arrivals) - 1
+    settled = all(abs(err) <= 2 * JITTER_S for i, err in phase_errs if i >= end + MAX_SETTLE_TICKS)
+    print(f'{DROPOUT_BEATS} beat dropout: coasted {tracker.coasted} ticks, sync index '
+          f'{tracker.cur_sync_idx} (expected {len(arrivals) - 1}), '
+          f'phase {"settled" if settled else "not settled"} after {MAX_SETTLE_TICKS} ticks')
+    return idx_ok and settled
+
+
+def main():
+    results = [steady_jitter(), late_bytes(), tempo_change(120, 128), tempo_change(128, 100),
+               *(flywheel_late(bpm, late_s) for bpm, late_s in FLYWHEEL_LATE), dropout()]
+    ok = all(results)
+    print('PASS' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Check that every MIDI note the adapter translates can be sent.
+
+Translates every note on every channel (see adapter.translate_note_to_msg)
+and encodes the result in both wire formats, as broadcasting it would, and
+decodes the binary frame back. A note giving a field out of its binary
+layout's range (e.g. a negative scene from a channel-14 note below middle
+C) would fail here rather than in broadcast_batch. Exits non-zero if any
+note fails.
+"""
+import json
+import sys
+
+from adapter import translate_note_to_msg
+import log
+from message import Msg, MsgGotoScene
+
+
+def main():
+    log.configure(['none'])
+    failures = []
+    for channel in range(1, 17):
+        for note in range(128):
+            for vel in (1, 99, 100, 127):
+                msg = translate_note_to_msg(channel, note, vel)
+                if msg is None:
+                    continue
+                try:
+                    json.loads(msg.encode(False))
+                    decoded = Msg.from_bytes(msg.encode(True))
+                    assert decoded.fields() == msg.fields()
+                except Exception as e:
+                    failures.append(f'channel {channel} note {note} vel {vel}: {e!r}')
+
+    # Channel 14 switches scenes from middle C up; lower notes are no scene.
+    low = translate_note_to_msg(14, 40, 100)
+    if low is not None:
+        failures.append(f'channel 14 note 40 gave {low!r}, expected nothing')
+    goto = translate_note_to_msg(14, 60, 100)
+    if not isinstance(goto, MsgGotoScene) or goto.scene != 0:
+        failures.append(f'channel 14 note 60 gave {goto!r}, expected scene 0')
+
+    for failure in failures[:20]:
+        print(failure)
+    print('PASS' if not failures else f'FAIL: {len(failures)} notes')
+    sys.exit(0 if not failures else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""Loopback check of relay mode's end-to-end timing.
+
+Starts `adapter.py --fake` and `adapter.py --relay` pointed at it on
+localhost, listens to both with binary clients for a few seconds, and matches
+up the syncs each delivered. Both processes share this machine's clock, so a
+relayed sync's restamped `t` must agree with the original's, its `latency`
+must have grown by the hop's, and it must arrive only a little after the
+original. Exits non-zero if not.
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+import websockets
+
+from message import Msg
+from wire import BINARY_ACK, BINARY_BATCH_HEADER, SUBPROTOCOL_BINARY
+
+UPSTREAM_PORT = 8765
+RELAY_PORT = 8767
+
+# Slack allowed for restamped t, given the relay's clock offset estimate.
+MAX_T_ERROR_S = 0.002
+
+
+async def listen(port, seconds):
+    """sync_idx -> (arrival time, t, latency) of each sync from `port`."""
+    syncs = {}
+    async with websockets.connect(f'ws://127.0.0.1:{port}',
+                                  subprotocols=[SUBPROTOCOL_BINARY]) as websocket:
+        t_end = time.time() + seconds
+        while time.time() < t_end:
+            frame = await websocket.recv()
+            now = time.time()
+            _, batch_latency, count = BINARY_BATCH_HEADER.unpack_from(frame)
+            msgs, _ = Msg.split_bytes(frame, count, BINARY_BATCH_HEADER.size)
+            for msg in msgs:
+                if msg.msg_type == Msg.Type.PING:
+                    await websocket.send(BINARY_ACK.pack(Msg.Type.ACK, msg.t, now))
+                elif msg.msg_type == Msg.Type.SYNC:
+                    syncs[msg.sync_idx] = (now, msg.t, msg.latency + batch_latency)
+    return syncs
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(p * len(sorted_values)))]
+
+
+async def check(seconds):
+    direct, relayed = await asyncio.gather(listen(UPSTREAM_PORT, seconds),
+                                           listen(RELAY_PORT, seconds))
+    # The relay only has a clock offset estimate after a few pings.
+    common = sorted(set(direct) & set(relayed))[len(direct) // 4:]
+    if not common:
+        print('FAIL: no syncs seen through both paths')
+        return False
+    hop_s = sorted(relayed[i][0] - direct[i][0] for i in common)
+    t_error_s = max(abs(relayed[i][1] - direct[i][1]) for i in common)
+    latency_added_s = sorted(relayed[i][2] - direct[i][2] for i in common)
+    print(f'{len(common)} syncs through both paths')
+    print(f'  extra arrival delay via relay  p50 {percentile(hop_s, 0.5) * 1e3:6.2f} ms  '
+          f'p99 {percentile(hop_s, 0.99) * 1e3:6.2f} ms')
+    print(f'  restamped t error              max {t_error_s * 1e3:6.2f} ms')
+    print(f'  latency added by relay         p50 {percentile(latency_added_s, 0.5) * 1e3:6.2f} ms')
+    ok = t_error_s <= MAX_T_ERROR_S and latency_added_s[0] > 0
+    print('PASS' if ok else 'FAIL')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay mode loopback timing check")
+    parser.add_argument('--seconds', type=float, default=5, help='listening time (default 5)')
+    args = parser.parse_args()
+
+    upstream = subprocess.Popen([sys.executable, 'adapter.py', '--fake', '160',
+                                 '--port', str(UPSTREAM_PORT)])
+    relay = subprocess.Popen([sys.executable, 'adapter.py', '--relay',
+                              f'ws://127.0.0.1:{UPSTREAM_PORT}', '--port', str(RELAY_PORT)])
+    try:
+        time.sleep(2)
+        ok = asyncio.run(check(args.seconds))
+    finally:
+        relay.terminate()
+        upstream.terminate()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Check SendQueue's drop policy.
+
+Queues a knob vector, then more beats than SEND_QUEUE_DROPPABLE_MAX, then
+another knob vector, and checks that the merged vector still holds both
+knobs' latest values, that only the oldest beats were dropped, and that
+nothing LATEST_ONLY was. Then checks that a sync or knob vector replacing a
+queued one comes out after a scene change queued between them, not before.
+Exits non-zero if not.
+"""
+import sys
+
+from message import MsgBeat, MsgGotoScene, MsgKnobVector, MsgPing, MsgSync
+from sendqueue import LATEST_ONLY, SEND_QUEUE_DROPPABLE_MAX, SendQueue
+
+NUM_BEATS = SEND_QUEUE_DROPPABLE_MAX + 8
+
+
+def drop_policy():
+    queue = SendQueue()
+    queue.put(MsgKnobVector(0, {1: 0.9}))
+    queue.put(MsgPing())
+    for i in range(NUM_BEATS):
+        queue.put(MsgBeat(0, i % 16))
+    queue.put(MsgKnobVector(0, {2: 0.3}))
+    queue.put(MsgPing())
+    dropped = dict(queue.stats()['dropped'])
+    msgs = queue.take()
+
+    vectors = [dict(zip(msg.wheel_idxs, msg.values)) for msg in msgs
+               if isinstance(msg, MsgKnobVector)]
+    beats = [msg for msg in msgs if isinstance(msg, MsgBeat)]
+    pings = [msg for msg in msgs if isinstance(msg, MsgPing)]
+    print(f'knob vectors {vectors}, {len(beats)} beats, {len(pings)} pings, dropped {dropped}')
+    ok = (vectors == [{1: 0.9, 2: 0.3}]
+          and len(beats) == SEND_QUEUE_DROPPABLE_MAX
+          and dropped == {'BEAT': NUM_BEATS - SEND_QUEUE_DROPPABLE_MAX}
+          and len(pings) == 1
+          and not any(name in dropped for name in (t.name for t in LATEST_ONLY)))
+    return ok
+
+
+def ordering():
+    queue = SendQueue()
+    queue.put(MsgSync(0, 64.0, 1))
+    queue.put(MsgKnobVector(0, {1: 0.9}))
+    queue.put(MsgGotoScene(0, 3, False))
+    queue.put(MsgSync(0, 64.0, 2))
+    queue.put(MsgKnobVector(0, {2: 0.3}))
+    depth = len(queue)
+    msgs = queue.take()
+    order = [type(msg).__name__ for msg in msgs]
+    print(f'sync, knob vector, scene change, sync, knob vector: sent {order}, depth {depth}')
+    return (order == ['MsgGotoScene', 'MsgSync', 'MsgKnobVector'] and depth == 3
+            and msgs[1].sync_idx == 2
+            and dict(zip(msgs[2].wheel_idxs, msgs[2].values)) == {1: 0.9, 2: 0.3})
+
+
+def main():
+    ok = all([drop_policy(), ordering()])
+    print('PASS' if ok else 'FAIL')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
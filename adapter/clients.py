@@ -0,0 +1,261 @@
+"""Per-connection state for websocket viewer clients."""
+import asyncio
+from collections import deque
+from http import HTTPStatus
+import json
+import time
+
+import websockets
+
+import log
+from message import Msg, MsgClockSync
+from sendqueue import SendQueue
+from wire import decode_client_msg, encode_frames, is_binary
+
+# Each client's RTT estimate takes the minimum of its last LATENCY_WINDOW
+# samples and smooths that with an EWMA of weight LATENCY_SMOOTHING. ACKs can
+# only be delayed, never early, so the windowed minimum rejects one-off spikes
+# (GC pauses, Wi-Fi retries) while still following a lasting change in path
+# latency within a window.
+LATENCY_WINDOW = 16
+LATENCY_SMOOTHING = 0.1
+
+# RTT samples outside [0, LATENCY_MAX_RTT_S] are discarded as bogus, e.g. an
+# ACK for a message sent before a long stall.
+LATENCY_MAX_RTT_S = 2.0
+
+# How often each client is sent a MsgPing to ACK, in seconds. Its latency
+# estimate is built from these ACKs only.
+PING_INTERVAL_S = 0.25
+
+# Clock sync, NTP style: each ping ACK that carries the client's receive time
+# gives a sample of the client's clock offset, t_client - (t_sent + t_recv) / 2,
+# accurate to within half the RTT. As in NTP's clock filter, only the
+# lowest-RTT sample of the last CLOCK_FILTER_WINDOW is trusted. Drift is the
+# least-squares slope of the trusted samples over the last CLOCK_DRIFT_WINDOW
+# of them, once they span at least CLOCK_DRIFT_MIN_SPAN_S; before that the
+# clocks are assumed to run at the same rate.
+CLOCK_FILTER_WINDOW = 8
+CLOCK_DRIFT_WINDOW = 64
+CLOCK_DRIFT_MIN_SPAN_S = 10.0
+
+# Larger drift estimates (in s/s) are taken as measurement noise and clamped;
+# real crystal oscillators are good to ~1e-4.
+CLOCK_MAX_DRIFT = 5e-4
+
+# Once this many bytes are waiting in a client's socket write buffer, new
+# messages for it go to its bounded send queue (see sendqueue.py) instead, so
+# a stalled client costs neither unbounded memory nor latency for the rest.
+# Also passed to websockets.serve(write_limit=...) so a send from the queue
+# waits for the buffer to drain below it.
+SEND_BUFFER_HIGH = 8192
+
+# HTTP path on the websocket port that reports per-client stats as JSON.
+STATS_PATH = '/stats'
+
+
+class LatencyEstimator:
+    """Smoothed round-trip time for one client, fed from its ACKs."""
+
+    def __init__(self):
+        self._window = deque(maxlen=LATENCY_WINDOW)
+        self.rtt_s = None
+        self.last_rtt_s = None
+        self.num_samples = 0
+        self.num_rejected = 0
+
+    def add(self, rtt_s):
+        self.last_rtt_s = rtt_s
+        if not 0 <= rtt_s <= LATENCY_MAX_RTT_S:
+            self.num_rejected += 1
+            return
+        self.num_samples += 1
+        self._window.append(rtt_s)
+        floor = min(self._window)
+        if self.rtt_s is None:
+            self.rtt_s = floor
+        else:
+            self.rtt_s += LATENCY_SMOOTHING * (floor - self.rtt_s)
+
+    @property
+    def latency_s(self):
+        """Estimated one-way latency: half the smoothed RTT."""
+        return self.rtt_s / 2 if self.rtt_s is not None else 0.0
+
+
+class ClockOffsetEstimator:
+    """Offset and drift of one client's clock relative to ours, fed from its
+    ping ACKs. The client's clock reads offset_s + drift * (t - ref_t) ahead
+    of ours at our time t."""
+
+    def __init__(self):
+        self._recent = deque(maxlen=CLOCK_FILTER_WINDOW)
+        self._trusted = deque(maxlen=CLOCK_DRIFT_WINDOW)
+        self.offset_s = None
+        self.drift = 0.0
+        self.ref_t = None
+
+    def add(self, t_sent, t_client, t_recv):
+        """Add one sample from a message sent at `t_sent` that the client
+        received at its time `t_client` and ACKed back by `t_recv`. Returns
+        whether the estimate changed."""
+        rtt_s = t_recv - t_sent
+        if not 0 <= rtt_s <= LATENCY_MAX_RTT_S:
+            return False
+        t_mid = (t_sent + t_recv) / 2
+        self._recent.append((rtt_s, t_mid, t_client - t_mid))
+        _, t_best, offset_best = min(self._recent)
+        if self._trusted and self._trusted[-1][0] == t_best:
+            return False
+        self._trusted.append((t_best, offset_best))
+        self.ref_t = t_best
+        self.offset_s = offset_best
+        self.drift = 0.0
+        span_s = t_best - self._trusted[0][0]
+        if span_s >= CLOCK_DRIFT_MIN_SPAN_S:
+            n = len(self._trusted)
+            mean_t = sum(t for t, _ in self._trusted) / n
+            mean_offset = sum(offset for _, offset in self._trusted) / n
+            var = sum((t - mean_t) ** 2 for t, _ in self._trusted)
+            cov = sum((t - mean_t) * (offset - mean_offset)
+                      for t, offset in self._trusted)
+            drift = max(-CLOCK_MAX_DRIFT, min(CLOCK_MAX_DRIFT, cov / var))
+            self.drift = drift
+            self.offset_s = mean_offset + drift * (t_best - mean_t)
+        return True
+
+    def to_msg(self):
+        return MsgClockSync(self.offset_s, self.ref_t, self.drift)
+
+
+class Client:
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.binary = is_binary(websocket)
+        self.latency = LatencyEstimator()
+        self.connected_at = time.time()
+        self.next_ping_t = self.connected_at
+        self.clock = ClockOffsetEstimator()
+        # Messages for this client only, sent along with the next broadcast.
+        self.outbox = []
+        # Which broadcast messages the client wants (a wire.Subscription), or
+        # None for all of them.
+        self.subscription = None
+        self.queue = SendQueue()
+        self._queue_ready = asyncio.Event()
+        self._writing = False
+
+    def ping_due(self, now):
+        """Whether the next frame sent to this client should carry a MsgPing.
+        Reschedules the following ping if so."""
+        if now < self.next_ping_t:
+            return False
+        self.next_ping_t = now + PING_INTERVAL_S
+        return True
+
+    def behind(self):
+        """Whether new messages for this client must wait in its send queue:
+        earlier ones still are, or its socket's write buffer is backed up."""
+        return (self._writing or len(self.queue) > 0
+                or self.websocket.transport.get_write_buffer_size() > SEND_BUFFER_HIGH)
+
+    def enqueue(self, msgs):
+        """Queue `msgs` for run_writer(). Drops the connection if the queue
+        overflows."""
+        for msg in msgs:
+            if not self.queue.put(msg):
+                log.clients("Client send queue overflowed; disconnecting")
+                self.websocket.transport.abort()
+                return
+        self._queue_ready.set()
+
+    async def run_writer(self):
+        """Send queued messages, one batch frame at a time, as fast as the
+        client takes them. Messages queued meanwhile are coalesced or dropped
+        by the queue's policy."""
+        try:
+            while True:
+                await self._queue_ready.wait()
+                self._queue_ready.clear()
+                self._writing = True
+                try:
+                    while len(self.queue) > 0:
+                        for frame in encode_frames(self.queue.take(), self.binary,
+                                                   self.latency.latency_s):
+                            await self.websocket.send(frame)
+                finally:
+                    self._writing = False
+        except websockets.ConnectionClosed:
+            pass
+
+    def handle_message(self, message):
+        """Handle one message received from the client: a SUBSCRIBE, or an
+        ACK echoing a MsgPing's `t`."""
+        t_recv = time.time()
+        msg_type, value = decode_client_msg(message)
+        if msg_type == Msg.Type.SUBSCRIBE:
+            self.subscription = value
+            return
+        t_sent, t_client = value
+        self.latency.add(t_recv - t_sent)
+        if self.clock.add(t_sent, t_client, t_recv):
+            self.outbox.append(self.clock.to_msg())
+
+    def stats(self):
+        host, port = self.websocket.remote_address[:2]
+        return {
+            'remote': f'{host}:{port}',
+            'subprotocol': self.websocket.subprotocol,
+            'connected_s': time.time() - self.connected_at,
+            'latency_s': self.latency.latency_s,
+            'rtt_s': self.latency.rtt_s,
+            'last_rtt_s': self.latency.last_rtt_s,
+            'rtt_samples': self.latency.num_samples,
+            'rtt_rejected': self.latency.num_rejected,
+            'clock_offset_s': self.clock.offset_s,
+            'clock_drift_ppm': self.clock.drift * 1e6,
+            'write_buffer': self.websocket.transport.get_write_buffer_size(),
+            'send_queue': self.queue.stats(),
+            'subscription': self.subscription and {
+                field: sorted(values) if isinstance(values, frozenset) else values
+                for field, values in self.subscription._asdict().items()
+            },
+        }
+
+
+async def serve_client(clients, websocket, state=None):
+    """websockets.serve handler body: register a Client in `clients` for the
+    lifetime of the connection and feed it everything the client sends. If
+    given a state.StateModel, first send the client its snapshot."""
+    client = Client(websocket)
+    snapshot = state.snapshot() if state is not None else []
+    if snapshot:
+        # Written before the client is registered for broadcasts, with no
+        # await in between, so nothing broadcast meanwhile is missed.
+        for frame in encode_frames(snapshot, client.binary, 0.0):
+            websockets.broadcast([websocket], frame)
+    clients.add(client)
+    writer = asyncio.create_task(client.run_writer())
+    log.clients("Client connected")
+    try:
+        async for message in websocket:
+            client.handle_message(message)
+    finally:
+        writer.cancel()
+        # Unregister client
+        clients.remove(client)
+        log.clients("Client disconnected")
+
+
+def stats_endpoint(clients):
+    """Return a websockets.serve process_request hook that answers plain HTTP
+    GETs of STATS_PATH with every client's stats, for inspection with e.g.
+    `curl http://<pi>:8765/stats`. Other paths go on to the websocket
+    handshake."""
+    async def process_request(path, request_headers):
+        if path != STATS_PATH:
+            return None
+        body = json.dumps([client.stats() for client in clients], indent=1)
+        return (HTTPStatus.OK, [('Content-Type', 'application/json')],
+                body.encode() + b'\n')
+    return process_request
@@ -0,0 +1,164 @@
+"""Recovering tempo and phase from MIDI clock ticks (24 per beat)."""
+import time
+
+# Ticks further apart than this mean the clock stopped; start over.
+BEAT_RESET_TIMEOUT_S = 1
+
+# Ticks seen before syncs are sent.
+MIN_BPM_SAMPLES = 4 * 24
+
+# Memory of the tempo estimate, in ticks, once it has settled: its gains stop
+# shrinking once they match a least-squares fit over this many ticks.
+NUM_BPM_SAMPLES = 16 * 24
+
+# Tempo change detection. A tick arriving further than CLOCK_RELOCK_SIGMAS
+# times the mean arrival jitter (plus CLOCK_RELOCK_MIN_ERR_S) from where it
+# was predicted is an outlier; CLOCK_RELOCK_TICKS outliers in a row, all on
+# the same side, mean the tempo changed rather than one byte was late. The
+# estimate then restarts with the memory of CLOCK_RELOCK_N ticks, growing
+# back from there, so it settles on the new tempo within about a beat.
+CLOCK_RELOCK_SIGMAS = 4.0
+CLOCK_RELOCK_MIN_ERR_S = 0.0005
+CLOCK_RELOCK_TICKS = 4
+CLOCK_RELOCK_N = 4
+
+# Flywheel: once syncing, a tick more than FLYWHEEL_GRACE_PERIODS periods
+# overdue means the clock has dropped out (a cable glitch, a pattern switch
+# on the drum machine), and coast() stands in for it and the ticks after,
+# from the last tempo and phase, so screens keep moving. When the clock comes
+# back its ticks pull the phase back into line through the usual filter.
+# After FLYWHEEL_MAX_S without a tick the tempo is forgotten. The grace is
+# over a period: a tick that is merely late (an event loop stall) arrives
+# before anything is coasted, and so is never counted twice.
+FLYWHEEL_GRACE_PERIODS = 1.5
+FLYWHEEL_MAX_S = 8.0
+
+# Weight of each tick's error in the mean arrival jitter. Errors count at
+# most up to the outlier threshold, so a tempo change doesn't inflate it.
+CLOCK_JITTER_SMOOTHING = 1 / 32
+
+
+class ClockTracker:
+    """An alpha-beta filter, i.e. a second-order phase-locked loop, on tick
+    arrival times. Each tick nudges the estimated tick time (the phase) and
+    period by a fraction of how far from the prediction it arrived. Starting
+    from the gains of a least-squares line fit over the ticks so far, it
+    locks on within a few ticks and then rejects more and more jitter, down
+    to a fit over NUM_BPM_SAMPLES ticks, in constant time per tick.
+
+    `tick_t` is the smoothed time of the latest tick and `sync_rate_hz` the
+    tick rate. While `coasting`, ticks are coasted rather than received."""
+
+    def __init__(self):
+        self.sync_rate_hz = 120 / 60 * 24
+        self.cur_sync_idx = -1      # Starts at -1 so first beat (ping, then send) will be beat 0
+        self.tick_t = None
+        self.period_s = 1 / self.sync_rate_hz
+        self.jitter_s = 0.0
+        self.sync = False
+        self.coasting = False
+        self.relocks = 0
+        self.coasted = 0
+        self._last_clock_est = None
+        self._n = 0
+        self._outliers = 0
+        self._last_err = 0.0
+
+    def ping(self, t=None):
+        """Count a clock pulse that arrived at `t` (default now). Returns
+        whether it is a new tick, rather than one already coasted."""
+        now = time.time() if t is None else t
+
+        predicted = None
+        if self.coasting:
+            self.coasting = False
+            # Which tick this is, from its phase against the last coasted
+            # one: that tick itself (if its arrival time is from before the
+            # coast), or a later one. Ticks in between were lost but not
+            # coasted yet, and are counted now.
+            ticks = round((now - self.tick_t) / self.period_s)
+            if ticks <= 0:
+                predicted = self.tick_t
+            else:
+                self.tick_t += (ticks - 1) * self.period_s
+                self.cur_sync_idx += ticks - 1
+        elif self._last_clock_est is not None and now - self._last_clock_est > BEAT_RESET_TIMEOUT_S:
+            self.reset_sync()
+        self._last_clock_est = now
+        new_tick = predicted is None
+        if new_tick:
+            self.cur_sync_idx += 1
+
+        if self._n == 0:
+            self.tick_t = now
+            self._n = 1
+            return True
+
+        if new_tick:
+            predicted = self.tick_t + self.period_s
+        err = now - predicted
+        if self._n > CLOCK_RELOCK_N:
+            self._check_relock(err)
+
+        # Least-squares gains for a line through n points, which are
+        # alpha = beta = 1 at n = 2: the period becomes the last interval.
+        self._n += 1
+        n = min(self._n, NUM_BPM_SAMPLES)
+        alpha = 2 * (2 * n - 1) / (n * (n + 1))
+        beta = 6 / (n * (n + 1))
+        self.tick_t = predicted + alpha * err
+        self.period_s += beta * err
+        self.sync_rate_hz = 1 / self.period_s
+
+        if self._n >= MIN_BPM_SAMPLES:
+            self.sync = True
+        return new_tick
+
+    def _check_relock(self, err):
+        threshold = CLOCK_RELOCK_SIGMAS * self.jitter_s + CLOCK_RELOCK_MIN_ERR_S
+        self.jitter_s += CLOCK_JITTER_SMOOTHING * (min(abs(err), threshold) - self.jitter_s)
+        if abs(err) <= threshold:
+            self._outliers = 0
+            return
+        if (err > 0) != (self._last_err > 0):
+            self._outliers = 0
+        self._outliers += 1
+        self._last_err = err
+        if self._outliers >= CLOCK_RELOCK_TICKS:
+            self._n = CLOCK_RELOCK_N - 1
+            self._outliers = 0
+            self.relocks += 1
+
+    def next_tick_t(self):
+        """When the next tick is expected."""
+        return self.tick_t + self.period_s
+
+    def coast_due_t(self):
+        """When to coast() if no tick has arrived by then, or None if there
+        is no tempo to coast on."""
+        if not self.sync:
+            return None
+        return self.tick_t + (1 + FLYWHEEL_GRACE_PERIODS) * self.period_s
+
+    def coast(self, now=None):
+        """Stand in for the overdue next tick, as if it came on time.
+        Returns whether it did, rather than giving up on the clock."""
+        if now is None:
+            now = time.time()
+        if now - self._last_clock_est > FLYWHEEL_MAX_S:
+            self.reset_sync()
+            return False
+        self.coasting = True
+        self.coasted += 1
+        self.tick_t += self.period_s
+        self.cur_sync_idx += 1
+        return True
+
+    def reset_sync(self):
+        self.coasting = False
+        self.cur_sync_idx = -1
+        self._last_clock_est = None
+        self._n = 0
+        self._outliers = 0
+        self.jitter_s = 0.0
+        self.sync = False
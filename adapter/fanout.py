@@ -0,0 +1,130 @@
+"""Multi-process websocket fan-out, for audiences of hundreds of clients.
+
+With `adapter.py --workers N` the source process (MIDI parsing, clock
+tracking) serves no websocket clients itself. Each broadcast is encoded once,
+as binary message frames, and published over a Unix socket to N worker
+processes. Each worker decodes the frames (keeping their encodings, see
+Msg.from_bytes) and runs the usual broadcast_batch to its own share of the
+clients, with per-client latency, pings, clock sync and send queues as
+before. The workers all listen on the websocket port with SO_REUSEPORT, so
+the kernel spreads new connections across them.
+
+/stats on the websocket port reports only the clients of whichever worker
+answers it.
+"""
+import asyncio
+import contextlib
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+
+import websockets
+
+from clients import SEND_BUFFER_HIGH, serve_client, stats_endpoint
+import log
+from message import Msg
+from state import StateModel
+from wire import SUBPROTOCOLS, broadcast_batch, encode_batch_body, observers
+
+# Published record header: body length (u32) and message count (u16),
+# followed by the body, the messages' binary frames back to back.
+FANOUT_HEADER = struct.Struct('<IH')
+
+# A worker with this many bytes of records unread is considered stuck and
+# disconnected, rather than buffering for it without bound.
+FANOUT_MAX_BUFFER = 1 << 20
+
+
+class FanoutPublisher:
+    """Publishes everything broadcast in the source process to each worker,
+    as one of wire.observers."""
+
+    def __init__(self):
+        self.workers = set()
+
+    def observe(self, msgs):
+        # There are no JSON-only messages in the broadcast stream; they
+        # couldn't be split back out of a record anyway.
+        msgs = [msg for msg in msgs if msg.BINARY_BODY is not None]
+        if not msgs or not self.workers:
+            return
+        body = encode_batch_body(msgs, True)
+        record = FANOUT_HEADER.pack(len(body), len(msgs)) + body
+        for writer in list(self.workers):
+            if writer.transport.get_write_buffer_size() > FANOUT_MAX_BUFFER:
+                log.clients("Fan-out worker fell behind; disconnecting it")
+                self.workers.discard(writer)
+                writer.close()
+                continue
+            writer.write(record)
+
+    async def handle_worker(self, reader, writer):
+        self.workers.add(writer)
+        try:
+            # Workers never send anything; this returns when one goes away.
+            await reader.read()
+        finally:
+            self.workers.discard(writer)
+
+
+@contextlib.asynccontextmanager
+async def serve_workers(num_workers, port):
+    """Start `num_workers` fan-out worker processes serving websocket clients
+    on `port`, fed with everything broadcast in this process."""
+    publisher = FanoutPublisher()
+    # A socket of our own, so adapters on one host don't take each other's.
+    socket_dir = tempfile.mkdtemp(prefix='visync-fanout-')
+    path = os.path.join(socket_dir, 'fanout.sock')
+    server = await asyncio.start_unix_server(publisher.handle_worker, path)
+    # Spawn rather than fork, so workers don't inherit the running loop.
+    mp = multiprocessing.get_context('spawn')
+    # Workers start with the default log categories; pass ours on.
+    log_categories = [name for name, category in log.CATEGORIES.items() if category.on]
+    workers = [mp.Process(target=run_worker, args=(path, port, log_categories), daemon=True)
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    observers.append(publisher)
+    try:
+        yield publisher
+    finally:
+        observers.remove(publisher)
+        for worker in workers:
+            worker.terminate()
+        server.close()
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+
+async def worker_main(path, port):
+    state = StateModel()
+    observers.append(state)
+    connected = set()
+
+    async def handler(websocket):
+        await serve_client(connected, websocket, state)
+
+    async with websockets.serve(handler, "0.0.0.0", port, subprotocols=SUBPROTOCOLS,
+                                process_request=stats_endpoint(connected),
+                                write_limit=SEND_BUFFER_HIGH, reuse_port=True):
+        reader, _writer = await asyncio.open_unix_connection(path)
+        log.clients('Fan-out worker %d serving port %d', os.getpid(), port)
+        while True:
+            try:
+                header = await reader.readexactly(FANOUT_HEADER.size)
+                length, count = FANOUT_HEADER.unpack(header)
+                body = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                log.clients('Fan-out worker %d: source went away', os.getpid())
+                return
+            msgs, _ = Msg.split_bytes(body, count)
+            broadcast_batch(connected, msgs)
+
+
+def run_worker(path, port, log_categories):
+    log.configure(log_categories)
+    try:
+        asyncio.run(worker_main(path, port))
+    except KeyboardInterrupt:
+        pass
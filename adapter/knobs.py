@@ -0,0 +1,44 @@
+import asyncio
+
+from message import MsgKnobVector
+from wire import broadcast
+
+# Default rate at which coalesced knob values are flushed to clients, in Hz.
+# Matches the client's frame rate; knobs can't visibly move faster than that.
+KNOB_FLUSH_HZ = 60
+
+
+class KnobCoalescer:
+    """Latest-value-wins buffer for control changes.
+
+    Sources hand every MsgControlChange to add(), which only records the value
+    per wheel_idx. run() flushes the knobs that changed since the last flush
+    as one MsgKnobVector at a fixed rate, so a knob sweep or a controller
+    sending a storm of CCs costs one small frame per flush instead of one
+    frame per CC, and never queues up ahead of the next sync.
+    """
+
+    def __init__(self, clients, rate_hz=KNOB_FLUSH_HZ):
+        self.clients = clients
+        self.rate_hz = rate_hz
+        self._pending = {}
+
+    def add(self, msg):
+        self._pending[msg.wheel_idx] = msg.value
+
+    def take(self):
+        """Return a MsgKnobVector of the knobs changed since the last call, or
+        None if none have."""
+        if not self._pending:
+            return None
+        knobs = self._pending
+        self._pending = {}
+        return MsgKnobVector(0, knobs)
+
+    async def run(self):
+        period_s = 1.0 / self.rate_hz
+        while True:
+            await asyncio.sleep(period_s)
+            msg = self.take()
+            if msg is not None:
+                broadcast(self.clients, msg)
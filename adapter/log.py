@@ -0,0 +1,132 @@
+"""Logging that never holds up the timing-critical paths.
+
+Lines are logged by category, e.g. `log.notes('%d:%d:%d', channel, note,
+vel)`. A disabled category returns straight away, before any formatting. An
+enabled one queues the format string and arguments for a background writer
+thread, which formats and prints them, so a slow terminal or journald only
+ever delays that thread. When the queue is full, lines are dropped and
+counted rather than waiting for room. Each category is also rate-limited
+by a token bucket: short bursts get through, but lines beyond its rate are
+counted and the count is reported with the next line that gets through.
+
+Categories are enabled with `adapter.py --log CATEGORY,...`, or
+configure().
+"""
+import atexit
+import queue
+import sys
+import threading
+import time
+
+# Lines waiting for the writer thread beyond this are dropped.
+LOG_QUEUE_MAX = 1024
+
+# Most lines per second logged in each category, averaged over a second:
+# up to this many may come at once.
+LOG_RATE_HZ = 50
+
+
+class Category:
+    """A named stream of log lines that can be switched on and off."""
+
+    __slots__ = ('name', 'on', 'rate_hz', '_tokens', '_last_t', '_suppressed')
+
+    def __init__(self, name, on=False, rate_hz=LOG_RATE_HZ):
+        self.name = name
+        self.on = on
+        self.rate_hz = rate_hz
+        self._tokens = rate_hz
+        self._last_t = 0.0
+        self._suppressed = 0
+
+    def __call__(self, fmt, *args):
+        if not self.on:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate_hz, self._tokens + (now - self._last_t) * self.rate_hz)
+        self._last_t = now
+        if self._tokens < 1:
+            self._suppressed += 1
+            return
+        self._tokens -= 1
+        suppressed, self._suppressed = self._suppressed, 0
+        _writer.submit((self.name, suppressed, fmt, args))
+
+
+class _Writer:
+    """Background thread printing queued lines."""
+
+    def __init__(self):
+        self.queue = queue.Queue(LOG_QUEUE_MAX)
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.run, name='log writer', daemon=True)
+        self.thread.start()
+
+    def submit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                return
+            name, suppressed, fmt, args = record
+            try:
+                line = fmt % args if args else fmt
+            except Exception as e:
+                # A bad format string mustn't take the writer down with it.
+                line = f'{fmt!r} % {args!r}  (bad log format: {e})'
+            if suppressed:
+                line += f'  ({suppressed} more {name} lines suppressed)'
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                line += f'  ({dropped} lines dropped, log queue full)'
+            try:
+                sys.stdout.write(line + '\n')
+                sys.stdout.flush()
+            except (OSError, ValueError):
+                pass
+
+    def close(self):
+        """Let the writer finish what is queued, briefly."""
+        try:
+            self.queue.put(None, timeout=0.5)
+        except queue.Full:
+            return
+        self.thread.join(timeout=1.0)
+
+
+_writer = _Writer()
+atexit.register(_writer.close)
+
+# Note-ons from MIDI sources.
+notes = Category('notes', on=True)
+# Control and program changes from MIDI sources.
+cc = Category('cc', on=True)
+# Tempo and position of each MIDI clock sync (was LOG_SYNC).
+sync = Category('sync')
+# Every non-sync message broadcast from MIDI sources (was LOG_MSGS).
+msgs = Category('msgs')
+# Raw messages from the APC40.
+apc40 = Category('apc40')
+# Clients connecting, disconnecting and being dropped.
+clients = Category('clients', on=True)
+# Jitter of the adapter's own clocks (see ticker.Ticker), every few seconds.
+timing = Category('timing')
+
+CATEGORIES = {category.name: category for category in
+              (notes, cc, sync, msgs, apc40, clients, timing)}
+
+
+def configure(names):
+    """Enable exactly the categories in `names`; 'all' enables them all and
+    'none' none."""
+    names = set(names)
+    unknown = names - set(CATEGORIES) - {'all', 'none'}
+    if unknown:
+        raise ValueError(f"unknown log categories: {', '.join(sorted(unknown))}")
+    for name, category in CATEGORIES.items():
+        category.on = 'all' in names or name in names
@@ -1,9 +1,19 @@
 import asyncio
 from enum import Enum
 import json
+import math
+import struct
 import time
 
 
+# Binary wire format: every frame starts with a common header of msg_type (u8),
+# t (f64) and latency (f32), followed by a fixed-layout body that depends on
+# msg_type. All fields are little-endian; web/src/wire.js decodes the same
+# layouts.
+BINARY_HEADER_FORMAT = '<Bdf'
+BINARY_HEADER_SIZE = struct.calcsize(BINARY_HEADER_FORMAT)
+
+
 class Msg:
     # enum for each message type
     class Type(int, Enum):
@@ -16,7 +26,24 @@ class Msg:
         ACK = 6
         PITCH_BEND = 7
         CONTROL_CHANGE = 8
-        PROGRAM_CHANGE = 8
+        PROGRAM_CHANGE = 9
+        BATCH = 10
+        KNOB_VECTOR = 11
+        PING = 12
+        CLOCK_SYNC = 13
+        SUBSCRIBE = 14
+        PREPARE_SCENE = 15
+
+    # Binary body layout for this message type: a struct format string (no byte
+    # order prefix) and the attributes it packs, in order. Types without one
+    # are always sent as JSON, whatever subprotocol the client negotiated.
+    BINARY_BODY = None
+    BINARY_FIELDS = ()
+
+    # Encoded frames, filled in on first use by encode(). A message must not
+    # be modified once it has been encoded.
+    _json_frame = None
+    _binary_frame = None
 
     def __init__(self, msg_type, last_transmit_latency):
         self.latency = last_transmit_latency
@@ -26,32 +53,146 @@ class Msg:
     def __repr__(self) -> str:
         return f'{self.t}: {self.msg_type}'
 
+    def fields(self):
+        """Public message fields, as sent in JSON frames."""
+        return {k: v for k, v in self.__dict__.items() if not k.startswith('_')}
+
     def to_json(self):
-        return json.dumps(self.__dict__)
+        return json.dumps(self.fields())
+
+    def to_bytes(self):
+        return self._binary_struct.pack(self.msg_type, self.t, self.latency,
+            *[getattr(self, field) for field in self.BINARY_FIELDS])
+
+    def encode(self, binary):
+        """Return this message's frame in the given format, serializing it only
+        the first time each format is asked for."""
+        if binary and self.BINARY_BODY is not None:
+            if self._binary_frame is None:
+                self._binary_frame = self.to_bytes()
+            return self._binary_frame
+        if self._json_frame is None:
+            self._json_frame = self.to_json()
+        return self._json_frame
+
+    def restamp(self, t, latency):
+        """Replace `t` and `latency`, e.g. when relaying a decoded message,
+        discarding any cached encodings."""
+        self.t = t
+        self.latency = latency
+        self._json_frame = None
+        self._binary_frame = None
+
+    @staticmethod
+    def from_bytes(buf):
+        """Decode a binary frame produced by to_bytes() back into a Msg. The
+        frame is kept as the message's cached binary encoding."""
+        cls = _binary_classes[buf[0]]
+        values = cls._binary_struct.unpack_from(buf)
+        msg = cls.__new__(cls)
+        msg._binary_frame = bytes(buf)
+        msg.msg_type = Msg.Type(values[0])
+        msg.t = values[1]
+        msg.latency = values[2]
+        msg._set_binary_body(values[3:], buf)
+        return msg
+
+    @staticmethod
+    def split_bytes(buf, count, offset=0):
+        """Decode `count` binary frames laid back to back in `buf` from
+        `offset` on, e.g. a batch body. Returns the messages and the offset
+        just past the last one."""
+        msgs = []
+        for _ in range(count):
+            cls = _binary_classes[buf[offset]]
+            end = offset + cls._binary_size(buf, offset)
+            msgs.append(Msg.from_bytes(buf[offset:end]))
+            offset = end
+        return msgs, offset
+
+    @classmethod
+    def _binary_size(cls, buf, offset):
+        """Size of the binary frame of this type starting at `offset`."""
+        return cls._binary_struct.size
+
+    def _set_binary_body(self, values, buf):
+        for field, value in zip(self.BINARY_FIELDS, values):
+            setattr(self, field, value)
 
 
 class MsgSync(Msg):
+    BINARY_BODY = 'fi'
+    BINARY_FIELDS = ('sync_rate_hz', 'sync_idx')
+
+    # Pre-built JSON frame with the same keys (and key order) json.dumps would
+    # produce. Syncs go out 48-96 times a second, so only the values are
+    # patched in rather than running json.dumps on each one.
+    _JSON_TEMPLATE = ('{"latency": %r, "msg_type": 0, "t": %r, '
+                      '"sync_rate_hz": %r, "sync_idx": %d}')
+
+    # Whether this sync departs from the tempo and phase of the ones before,
+    # so it goes even to clients that take only some syncs (see
+    # wire.SyncKeyframes). None until broadcast.
+    _keyframe = None
+
     def __init__(self, last_transmit_latency, sync_rate_hz, sync_idx):
         super().__init__(Msg.Type.SYNC, last_transmit_latency)
         self.sync_rate_hz = sync_rate_hz
         self.sync_idx = sync_idx
 
+    def to_json(self):
+        latency, t, sync_rate_hz = float(self.latency), float(self.t), float(self.sync_rate_hz)
+        if math.isfinite(latency) and math.isfinite(t) and math.isfinite(sync_rate_hz):
+            return MsgSync._JSON_TEMPLATE % (latency, t, sync_rate_hz, self.sync_idx)
+        # %r, like json.dumps, would write inf or nan, which JSON.parse
+        # rejects along with the rest of the batch; send null instead.
+        return json.dumps({k: None if isinstance(v, float) and not math.isfinite(v) else v
+                           for k, v in self.fields().items()})
+
 
 class MsgBeat(Msg):
+    BINARY_BODY = 'B?'
+    BINARY_FIELDS = ('channel', 'on')
+
     def __init__(self, last_transmit_latency, channel, on=True):
         super().__init__(Msg.Type.BEAT, last_transmit_latency)
         self.channel = channel
         self.on = on
 
 
+# Scene messages take effect on the sync with index `at_sync_idx`, or at once
+# if it is -1 (see scenes.SceneScheduler).
+AT_ONCE = -1
+
+
 class MsgGotoScene(Msg):
-    def __init__(self, last_transmit_latency, scene, bg=False):
+    BINARY_BODY = 'H?i'
+    BINARY_FIELDS = ('scene', 'bg', 'at_sync_idx')
+
+    def __init__(self, last_transmit_latency, scene, bg=False, at_sync_idx=AT_ONCE):
         super().__init__(Msg.Type.GOTO_SCENE, last_transmit_latency)
         self.scene = scene
         self.bg = bg
+        self.at_sync_idx = at_sync_idx
+
+
+class MsgPrepareScene(Msg):
+    """A hint that `scene` will be shown from sync `at_sync_idx`, so clients
+    can compile its shaders and upload its geometry beforehand rather than on
+    the beat it appears. Changes nothing on screen."""
+    BINARY_BODY = 'Hi'
+    BINARY_FIELDS = ('scene', 'at_sync_idx')
+
+    def __init__(self, last_transmit_latency, scene, at_sync_idx):
+        super().__init__(Msg.Type.PREPARE_SCENE, last_transmit_latency)
+        self.scene = scene
+        self.at_sync_idx = at_sync_idx
 
 
 class MsgControlChange(Msg):
+    BINARY_BODY = 'Bf'
+    BINARY_FIELDS = ('wheel_idx', 'value')
+
     # `value` is normalized to the range [0, 1]; consumers scale it as needed.
     def __init__(self, last_transmit_latency, wheel_idx, value):
         super().__init__(Msg.Type.CONTROL_CHANGE, last_transmit_latency)
@@ -60,6 +201,9 @@ class MsgControlChange(Msg):
 
 
 class MsgProgramChange(Msg):
+    BINARY_BODY = 'BB'
+    BINARY_FIELDS = ('channel', 'value')
+
     def __init__(self, last_transmit_latency, channel, value):
         super().__init__(Msg.Type.PROGRAM_CHANGE, last_transmit_latency)
         self.channel = channel
@@ -67,18 +211,100 @@ class MsgProgramChange(Msg):
 
 
 class MsgPitchBend(Msg):
+    BINARY_BODY = 'H'
+    BINARY_FIELDS = ('value',)
+
     def __init__(self, last_transmit_latency, value):
         super().__init__(Msg.Type.PITCH_BEND, last_transmit_latency)
         self.value = value
 
 
 class MsgAdvanceSceneState(Msg):
-    def __init__(self, last_transmit_latency, steps):
+    BINARY_BODY = 'hi'
+    BINARY_FIELDS = ('steps', 'at_sync_idx')
+
+    def __init__(self, last_transmit_latency, steps, at_sync_idx=AT_ONCE):
         super().__init__(Msg.Type.ADVANCE_SCENE_STATE, last_transmit_latency)
         self.steps = steps
+        self.at_sync_idx = at_sync_idx
+
+
+class MsgKnobVector(Msg):
+    """Latest values of several knobs at once, as flushed by a
+    KnobCoalescer. `wheel_idxs` and `values` are parallel lists; values are
+    normalized to [0, 1] like MsgControlChange's."""
+
+    # Variable-length binary body: the knob count (u8), then a wheel_idx (u8)
+    # and value (f32) pair per knob.
+    BINARY_BODY = 'B'
+
+    def __init__(self, last_transmit_latency, knobs):
+        super().__init__(Msg.Type.KNOB_VECTOR, last_transmit_latency)
+        self.wheel_idxs = list(knobs.keys())
+        self.values = list(knobs.values())
+
+    def to_bytes(self):
+        count = len(self.wheel_idxs)
+        pairs = [x for pair in zip(self.wheel_idxs, self.values) for x in pair]
+        return (self._binary_struct.pack(self.msg_type, self.t, self.latency, count)
+                + struct.pack('<' + 'Bf' * count, *pairs))
+
+    @classmethod
+    def _binary_size(cls, buf, offset):
+        count = buf[offset + cls._binary_struct.size - 1]
+        return cls._binary_struct.size + 5 * count
+
+    def _set_binary_body(self, values, buf):
+        count = values[0]
+        pairs = struct.unpack_from('<' + 'Bf' * count, buf, self._binary_struct.size)
+        self.wheel_idxs = list(pairs[0::2])
+        self.values = list(pairs[1::2])
+
+
+class MsgPing(Msg):
+    """Asks the client to ACK (echo back `t`). Only pings are acked, so the
+    server sees a few ACKs per second per client rather than one per message."""
+    BINARY_BODY = ''
+
+    def __init__(self):
+        super().__init__(Msg.Type.PING, 0)
+
+
+class MsgClockSync(Msg):
+    """One client's clock relative to the adapter's, estimated from its ping
+    ACKs (see clients.ClockOffsetEstimator): at adapter time `ref_t` the
+    client's clock reads `offset` seconds ahead, drifting by `drift` seconds
+    per second after that. Lets the client map message times onto its own
+    clock."""
+    BINARY_BODY = 'ddf'
+    BINARY_FIELDS = ('offset', 'ref_t', 'drift')
+
+    def __init__(self, offset, ref_t, drift):
+        super().__init__(Msg.Type.CLOCK_SYNC, 0)
+        self.offset = offset
+        self.ref_t = ref_t
+        self.drift = drift
 
 
 class MsgPromotion(Msg):
     def __init__(self, secret):
         super().__init__(Msg.Type.PROMOTION, 0)
         self.secret = secret
+
+
+# msg_type byte -> class, for every message type with a binary layout.
+_binary_classes = {
+    Msg.Type.SYNC: MsgSync,
+    Msg.Type.BEAT: MsgBeat,
+    Msg.Type.GOTO_SCENE: MsgGotoScene,
+    Msg.Type.ADVANCE_SCENE_STATE: MsgAdvanceSceneState,
+    Msg.Type.PREPARE_SCENE: MsgPrepareScene,
+    Msg.Type.PITCH_BEND: MsgPitchBend,
+    Msg.Type.CONTROL_CHANGE: MsgControlChange,
+    Msg.Type.PROGRAM_CHANGE: MsgProgramChange,
+    Msg.Type.KNOB_VECTOR: MsgKnobVector,
+    Msg.Type.PING: MsgPing,
+    Msg.Type.CLOCK_SYNC: MsgClockSync,
+}
+for _cls in _binary_classes.values():
+    _cls._binary_struct = struct.Struct(BINARY_HEADER_FORMAT + _cls.BINARY_BODY)
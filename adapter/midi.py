@@ -0,0 +1,91 @@
+"""Splitting a raw MIDI byte stream (e.g. from the serial port) into
+messages."""
+from rtmidi import midiconstants
+
+
+def _data_lengths():
+    """Number of data bytes following each status byte, indexed by status
+    byte. Data bytes (below 0x80) map to None."""
+    lengths = [None] * 0x80 + [0] * 0x80
+    for status in range(0x80, 0xF0):
+        kind = status & 0xF0
+        if kind in (midiconstants.PROGRAM_CHANGE, midiconstants.CHANNEL_PRESSURE):
+            lengths[status] = 1
+        else:
+            lengths[status] = 2
+    lengths[midiconstants.MIDI_TIME_CODE] = 1
+    lengths[midiconstants.SONG_POSITION_POINTER] = 2
+    lengths[midiconstants.SONG_SELECT] = 1
+    return lengths
+
+
+DATA_LENGTHS = _data_lengths()
+
+# Status bytes at or above this are realtime (clock, start, stop, ...): one
+# byte long, allowed anywhere in the stream, even inside another message.
+REALTIME_MIN = midiconstants.TIMING_CLOCK
+
+
+class MidiParser:
+    """Turns chunks of a MIDI byte stream into messages, each a tuple of its
+    status byte and data bytes, e.g. (0x90, note, velocity) or (0xF8,).
+
+    Handles running status (data bytes that reuse the last channel status),
+    realtime bytes interleaved anywhere, and skips system exclusive dumps.
+    Messages split across chunks are completed by the next feed().
+    """
+
+    def __init__(self):
+        self._status = None       # running status, None if there is none
+        self._length = 0          # data bytes the status takes
+        self._first = None        # first data byte of a two-byte message
+        self._in_sysex = False
+
+    def feed(self, buf):
+        """Parse the bytes in `buf`; return the list of complete messages."""
+        msgs = []
+        append = msgs.append
+        lengths = DATA_LENGTHS
+        status = self._status
+        length = self._length
+        first = self._first
+        in_sysex = self._in_sysex
+        for b in buf:
+            if b >= 0x80:
+                if b >= REALTIME_MIN:
+                    append((b,))
+                    continue
+                first = None
+                if b == midiconstants.SYSTEM_EXCLUSIVE:
+                    in_sysex = True
+                    status = None
+                elif b == midiconstants.END_OF_EXCLUSIVE:
+                    in_sysex = False
+                    status = None
+                else:
+                    in_sysex = False
+                    length = lengths[b]
+                    if length:
+                        status = b
+                    else:
+                        append((b,))
+                        status = None
+            elif status is None or in_sysex:
+                continue
+            elif length == 1:
+                append((status, b))
+                if status >= 0xF0:
+                    # System common messages don't set running status.
+                    status = None
+            elif first is None:
+                first = b
+            else:
+                append((status, first, b))
+                first = None
+                if status >= 0xF0:
+                    status = None
+        self._status = status
+        self._length = length
+        self._first = first
+        self._in_sysex = in_sysex
+        return msgs
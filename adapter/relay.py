@@ -0,0 +1,74 @@
+"""Relay mode: re-broadcast another adapter's stream (`adapter.py --relay`).
+
+The relay connects to the upstream adapter as an ordinary binary client,
+ACKing its pings with its own clock like main.js does, so the upstream
+estimates the hop's latency and clock offset and sends them back (as each
+batch's latency and in MsgClockSync). Every relayed message is restamped
+before it goes out to the relay's own clients: `t` is mapped onto the relay's
+clock and the hop's one-way latency is added to `latency`.
+"""
+import asyncio
+import time
+
+import websockets
+
+from message import Msg
+from wire import BINARY_ACK, BINARY_BATCH_HEADER, SUBPROTOCOL_BINARY, broadcast_batch
+
+# Seconds to wait before reconnecting to a lost upstream.
+RELAY_RETRY_S = 1.0
+
+
+class UpstreamClock:
+    """The upstream's clock relative to ours, from its MsgClockSync (see
+    clients.ClockOffsetEstimator). Until the first one arrives, the clocks
+    are assumed to agree."""
+
+    def __init__(self):
+        self.offset = 0.0
+        self.ref_t = 0.0
+        self.drift = 0.0
+
+    def update(self, msg):
+        self.offset = msg.offset
+        self.ref_t = msg.ref_t
+        self.drift = msg.drift
+
+    def to_local(self, upstream_t):
+        return upstream_t + self.offset + self.drift * (upstream_t - self.ref_t)
+
+
+async def relay_frames(upstream, clients):
+    clock = UpstreamClock()
+    async for frame in upstream:
+        t_recv = time.time()
+        if not isinstance(frame, bytes):
+            # Only messages without a binary layout come as JSON, and the
+            # adapter broadcasts none.
+            continue
+        _, hop_latency, count = BINARY_BATCH_HEADER.unpack_from(frame)
+        msgs, _ = Msg.split_bytes(frame, count, BINARY_BATCH_HEADER.size)
+        relayed = []
+        for msg in msgs:
+            if msg.msg_type == Msg.Type.PING:
+                await upstream.send(BINARY_ACK.pack(Msg.Type.ACK, msg.t, t_recv))
+            elif msg.msg_type == Msg.Type.CLOCK_SYNC:
+                clock.update(msg)
+            else:
+                msg.restamp(clock.to_local(msg.t), msg.latency + hop_latency)
+                relayed.append(msg)
+        if relayed:
+            broadcast_batch(clients, relayed)
+
+
+async def relay_loop(url, clients):
+    """Re-broadcast everything from the adapter at `url` to `clients`,
+    reconnecting whenever the upstream goes away."""
+    while True:
+        try:
+            async with websockets.connect(url, subprotocols=[SUBPROTOCOL_BINARY]) as upstream:
+                print(f"Relaying {url}")
+                await relay_frames(upstream, clients)
+        except (OSError, websockets.ConnectionClosed) as e:
+            print(f"Lost upstream {url}: {e}")
+        await asyncio.sleep(RELAY_RETRY_S)
@@ -0,0 +1,93 @@
+"""Scene cycling (`adapter.py --cycle N`), scheduled ahead on the sync
+timeline."""
+import random
+
+from message import MsgAdvanceSceneState, MsgGotoScene, MsgPrepareScene
+
+NUM_SCENES = 23
+
+# Scene messages go out this many syncs before the sync they take effect on,
+# tagged with it (at_sync_idx), so clients can switch exactly on that sync
+# however late the message arrives within this window.
+SCENE_LOOKAHEAD_SYNCS = 24
+
+
+class SceneScheduler:
+    """Cycles scenes every `cycle_interval` bars, and advances the scene state
+    once halfway between changes. Fed each sync_idx through on_sync(), it
+    works out the boundaries coming up within SCENE_LOOKAHEAD_SYNCS and
+    returns each one's messages exactly once, ahead of time.
+
+    Each new scene is picked one scene ahead, when the one before it goes
+    on screen, and announced then with a MsgPrepareScene so clients can get
+    it ready while the current scenes play."""
+
+    def __init__(self, cycle_interval):
+        self.cycle_interval = cycle_interval * 4 * 24   # 24 syncs per beat
+        self.cur_scenes = [1, 0]  # [fg, bg]
+        self.next_scene = random.randint(1, NUM_SCENES)
+        self.last_sync_idx = None
+        self.scheduled_through = None  # last sync_idx whose boundary was sent
+
+    def on_sync(self, sync_idx):
+        """Return the messages for boundaries that came within look-ahead of
+        `sync_idx`, each tagged with its boundary's sync_idx."""
+        if self.cycle_interval == 0:
+            return []
+        msgs = []
+        if self.last_sync_idx is None or sync_idx < self.last_sync_idx:
+            # Started, or the sync count was reset: plan afresh from here,
+            # and announce the next scene again at its new boundary.
+            self.scheduled_through = sync_idx - 1
+            msgs.append(self.prepare_next(self.scheduled_through))
+        self.last_sync_idx = sync_idx
+        while True:
+            boundary = self.next_boundary(self.scheduled_through)
+            if boundary > sync_idx + SCENE_LOOKAHEAD_SYNCS:
+                return msgs
+            if boundary % self.cycle_interval == 0:
+                msgs += self.cycle(boundary)
+            else:
+                msgs.append(MsgAdvanceSceneState(0, 1, boundary))
+            self.scheduled_through = boundary
+
+    def next_boundary(self, after):
+        """The first scene change or advance point after sync_idx `after`:
+        they alternate every half interval."""
+        half = self.cycle_interval // 2
+        return (after // half + 1) * half
+
+    def prepare_next(self, after):
+        """The hint for next_scene, which goes on screen at the first scene
+        change after sync_idx `after` that adds a scene: with both fg and bg
+        shown, the next change only blanks fg, so it is the one after."""
+        at_sync_idx = (after // self.cycle_interval + 1) * self.cycle_interval
+        if all(self.cur_scenes):
+            at_sync_idx += self.cycle_interval
+        return MsgPrepareScene(0, self.next_scene, at_sync_idx)
+
+    def cycle(self, at_sync_idx):
+        """Messages for the scene change at `at_sync_idx`."""
+        fg, bg = self.cur_scenes
+        messages = []
+
+        if fg and bg:
+            # Both have scenes: blank fg
+            self.cur_scenes[0] = 0
+            messages.append(MsgGotoScene(0, 0, False, at_sync_idx))
+        else:
+            # At least one blank: add new scene
+            if fg == 0 and bg:
+                # Promote bg to fg first
+                messages.append(MsgGotoScene(0, bg, False, at_sync_idx))
+                self.cur_scenes[0] = bg
+            # Add new scene to bg (or fg if both were blank)
+            new_scene = self.next_scene
+            target_bg = (self.cur_scenes[0] != 0)
+            self.cur_scenes[1 if target_bg else 0] = new_scene
+            messages.append(MsgGotoScene(0, new_scene, target_bg, at_sync_idx))
+            # Pick the scene after it now, so clients have until then.
+            self.next_scene = random.randint(1, NUM_SCENES)
+            messages.append(self.prepare_next(at_sync_idx))
+
+        return messages
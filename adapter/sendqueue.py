@@ -0,0 +1,114 @@
+"""Bounded per-client send queue.
+
+A client whose socket can't keep up has its messages wait here rather than in
+an ever-growing socket write buffer (see Client.enqueue). The queue stays
+small by message class:
+
+* Sync, scene changes and the like are must-deliver.
+* Of each LATEST_ONLY type (syncs, knob vectors, pitch bends, pings) only the
+  newest matters: a newer one replaces the queued one, so each holds at most
+  one slot and is never dropped. It goes to the back of the queue, not into
+  the old one's slot, so it never overtakes messages queued before it.
+  Queued knob vectors are merged rather than replaced, so no knob's latest
+  value is lost.
+* Beats and control changes are DROPPABLE: past SEND_QUEUE_DROPPABLE_MAX of
+  them, the oldest go.
+
+Only must-deliver messages can then push the queue past SEND_QUEUE_MAX; if
+they do, the client is hopeless and put() says so.
+"""
+from collections import deque
+
+from message import Msg, MsgKnobVector
+
+SEND_QUEUE_MAX = 256
+SEND_QUEUE_DROPPABLE_MAX = 32
+
+LATEST_ONLY = {
+    Msg.Type.SYNC,
+    Msg.Type.KNOB_VECTOR,
+    Msg.Type.PITCH_BEND,
+    Msg.Type.PING,
+    Msg.Type.CLOCK_SYNC,
+}
+
+# Disjoint from LATEST_ONLY, whose types already hold one slot each.
+DROPPABLE = {
+    Msg.Type.BEAT,
+    Msg.Type.CONTROL_CHANGE,
+}
+
+
+def merge_knob_vectors(old, new):
+    knobs = dict(zip(old.wheel_idxs, old.values))
+    knobs.update(zip(new.wheel_idxs, new.values))
+    return MsgKnobVector(new.latency, knobs)
+
+
+class SendQueue:
+    def __init__(self):
+        # One-element lists ("cells") holding each message in send order, so
+        # a message can be dropped in place. Dropped and replaced cells hold
+        # None until the next take() or compaction.
+        self._cells = deque()
+        self._droppable = deque()
+        self._latest = {}
+        self.depth = 0
+        self.max_depth = 0
+        self.num_coalesced = 0
+        self.num_dropped = {}
+
+    def __len__(self):
+        return self.depth
+
+    def put(self, msg):
+        """Queue `msg`, applying the drop policy. Returns False if the queue
+        has overflowed with must-deliver messages."""
+        msg_type = msg.msg_type
+        if msg_type in LATEST_ONLY:
+            cell = self._latest.get(msg_type)
+            if cell is not None and cell[0] is not None:
+                if msg_type == Msg.Type.KNOB_VECTOR:
+                    msg = merge_knob_vectors(cell[0], msg)
+                cell[0] = None
+                self.depth -= 1
+                self.num_coalesced += 1
+        cell = [msg]
+        self._cells.append(cell)
+        self.depth += 1
+        if msg_type in LATEST_ONLY:
+            self._latest[msg_type] = cell
+        if msg_type in DROPPABLE:
+            self._droppable.append(cell)
+            while len(self._droppable) > SEND_QUEUE_DROPPABLE_MAX:
+                self._drop(self._droppable.popleft())
+        if len(self._cells) > 2 * SEND_QUEUE_MAX:
+            self._compact()
+        self.max_depth = max(self.max_depth, self.depth)
+        return self.depth <= SEND_QUEUE_MAX
+
+    def take(self):
+        """Remove and return every queued message, in send order."""
+        msgs = [cell[0] for cell in self._cells if cell[0] is not None]
+        self._cells.clear()
+        self._droppable.clear()
+        self._latest.clear()
+        self.depth = 0
+        return msgs
+
+    def _drop(self, cell):
+        name = cell[0].msg_type.name
+        self.num_dropped[name] = self.num_dropped.get(name, 0) + 1
+        cell[0] = None
+        self.depth -= 1
+
+    def _compact(self):
+        self._cells = deque(cell for cell in self._cells if cell[0] is not None)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'max_depth': self.max_depth,
+            'coalesced': self.num_coalesced,
+            'dropped': self.num_dropped,
+        }
@@ -0,0 +1,57 @@
+"""Compact model of the show's current state, sent to clients that join
+mid-set so they show the right scenes and knobs straight away."""
+from message import AT_ONCE, Msg, MsgAdvanceSceneState, MsgGotoScene, MsgKnobVector
+
+
+class StateModel:
+    """Follows everything broadcast in its process, as one of wire.observers.
+    Tracks the foreground and background scenes, the scene state steps taken
+    since the last scene change, the scene announced to come next, the last
+    value of every knob and the last sync."""
+
+    def __init__(self):
+        self.scenes = {False: None, True: None}  # bg -> scene
+        # bg -> the sync_idx the scene change takes effect on, as it may
+        # still be ahead (see scenes.SceneScheduler).
+        self.scene_at = {False: AT_ONCE, True: AT_ONCE}
+        self.steps = 0
+        self.prepare = None  # the last MsgPrepareScene
+        self.knobs = {}
+        self.last_sync = None
+
+    def observe(self, msgs):
+        for msg in msgs:
+            msg_type = msg.msg_type
+            if msg_type == Msg.Type.SYNC:
+                self.last_sync = msg
+            elif msg_type == Msg.Type.KNOB_VECTOR:
+                self.knobs.update(zip(msg.wheel_idxs, msg.values))
+            elif msg_type == Msg.Type.CONTROL_CHANGE:
+                self.knobs[msg.wheel_idx] = msg.value
+            elif msg_type == Msg.Type.GOTO_SCENE:
+                self.scenes[bool(msg.bg)] = msg.scene
+                self.scene_at[bool(msg.bg)] = msg.at_sync_idx
+                self.steps = 0
+            elif msg_type == Msg.Type.ADVANCE_SCENE_STATE:
+                self.steps += msg.steps
+            elif msg_type == Msg.Type.PREPARE_SCENE:
+                self.prepare = msg
+
+    def snapshot(self):
+        """Messages that bring a new client up to date, in the order to
+        apply them."""
+        msgs = []
+        for bg in (True, False):
+            if self.scenes[bg] is not None:
+                msgs.append(MsgGotoScene(0, self.scenes[bg], bg, self.scene_at[bg]))
+        if self.steps:
+            # The binary body's steps field is an int16.
+            steps = max(-0x8000, min(0x7fff, self.steps))
+            msgs.append(MsgAdvanceSceneState(0, steps))
+        if self.prepare is not None:
+            msgs.append(self.prepare)
+        if self.knobs:
+            msgs.append(MsgKnobVector(0, self.knobs))
+        if self.last_sync is not None:
+            msgs.append(self.last_sync)
+        return msgs
@@ -0,0 +1,193 @@
+"""Drift-free, low-jitter timing for the clocks the adapter generates itself:
+the fake source, fake knob movement and the flywheel that coasts over MIDI
+clock dropouts.
+
+asyncio.sleep() wakes a task when the event loop next gets round to it,
+which is late by however long the callbacks ahead of it run; with many
+clients those are fan-out sends, so the jitter of the generated clock grew
+with the audience. A Ticker instead waits in its own thread for absolute
+deadlines (on time.time(), like message `t`s): it sleeps until just short of
+each one, spins the rest of the way, and hands the tick to the event loop
+with the deadline attached. Deadlines are computed from the first, never
+from the last wakeup, so lateness doesn't accumulate into drift, and
+messages can be stamped with the deadline rather than when the loop ran
+them.
+"""
+import asyncio
+from collections import deque
+import os
+import sys
+import threading
+import time
+
+import log
+
+# A Ticker's thread sleeps until this long before each deadline, then spins.
+# Long enough to cover the usual oversleep of a timed wait.
+TICKER_SPIN_S = 0.001
+
+# The Python interpreter lets a thread waiting for the GIL take it from the
+# running one only after its switch interval, 5 ms by default, which can
+# hold a tick up behind the event loop. Set this to lower it (e.g. to
+# 0.0005) while any Ticker runs. It applies to the whole process, so it also
+# means more GIL hand-offs on the websocket and fan-out path; off by default.
+TICKER_SWITCH_INTERVAL_S = None
+
+# Real-time (SCHED_FIFO) priority asked for for Ticker threads, on Linux.
+# Needs CAP_SYS_NICE (or an rtprio limit); without it they run at normal
+# priority.
+TICKER_RT_PRIORITY = 10
+
+# Jitter statistics cover this many of the latest ticks, and are logged
+# (`--log timing`) this often.
+TICKER_STATS_TICKS = 4096
+TICKER_REPORT_S = 10.0
+
+
+# Tickers running with the switch interval lowered, and what it was before.
+_lowered = 0
+_saved_switch_interval = None
+
+
+def _lower_switch_interval():
+    global _lowered, _saved_switch_interval
+    if _lowered == 0:
+        _saved_switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(min(_saved_switch_interval, TICKER_SWITCH_INTERVAL_S))
+    _lowered += 1
+
+
+def _restore_switch_interval():
+    global _lowered
+    _lowered -= 1
+    if _lowered == 0:
+        sys.setswitchinterval(_saved_switch_interval)
+
+
+def percentiles(values, qs=(0.5, 0.99, 0.999)):
+    """The `qs` quantiles of `values`, nearest rank, or None if empty."""
+    if not values:
+        return None
+    values = sorted(values)
+    return [values[min(len(values) - 1, int(q * len(values)))] for q in qs]
+
+
+def _raise_priority():
+    """Ask for real-time scheduling for the calling thread. Returns whether
+    it was granted."""
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(TICKER_RT_PRIORITY))
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+class Ticker:
+    """Calls `on_tick(deadline)` in the event loop at each deadline it is
+    armed for. arm() sets the next deadline, and optionally a period to
+    repeat at after it; it may be called from the event loop at any time,
+    including from on_tick, to move the deadline. Runs while run() is
+    awaited.
+
+    Keeps the lateness of its latest ticks, both when the thread woke for
+    them and when the event loop ran on_tick; stats() gives percentiles."""
+
+    def __init__(self, name, on_tick):
+        self.name = name
+        self.on_tick = on_tick
+        self.realtime = False
+        self._cond = threading.Condition()
+        self._deadline = None
+        self._period_s = None
+        self._stopped = False
+        self._loop = None
+        self._wake_late = deque(maxlen=TICKER_STATS_TICKS)
+        self._tick_late = deque(maxlen=TICKER_STATS_TICKS)
+        self._intervals = deque(maxlen=TICKER_STATS_TICKS)
+        self._last = None  # (deadline, time on_tick ran) of the last tick
+
+    def arm(self, deadline, period_s=None):
+        """Tick at `deadline`, and every `period_s` after it if given;
+        `deadline` None disarms."""
+        with self._cond:
+            self._deadline = deadline
+            self._period_s = period_s
+            self._cond.notify()
+
+    async def run(self):
+        """Run the timer thread until cancelled, logging its jitter every
+        TICKER_REPORT_S."""
+        self._loop = asyncio.get_running_loop()
+        lower = TICKER_SWITCH_INTERVAL_S is not None
+        if lower:
+            _lower_switch_interval()
+        thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        thread.start()
+        try:
+            while True:
+                await asyncio.sleep(TICKER_REPORT_S)
+                log.timing('%s', self.report())
+        finally:
+            with self._cond:
+                self._stopped = True
+                self._cond.notify()
+            if lower:
+                _restore_switch_interval()
+
+    def _run(self):
+        self.realtime = _raise_priority()
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._deadline is None:
+                        self._cond.wait()
+                        continue
+                    wait = self._deadline - TICKER_SPIN_S - time.time()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                if self._stopped:
+                    return
+                deadline = self._deadline
+            while time.time() < deadline:
+                pass
+            woke = time.time()
+            with self._cond:
+                if self._deadline != deadline:
+                    continue    # Re-armed while spinning.
+                self._deadline = deadline + self._period_s if self._period_s else None
+            self._wake_late.append(woke - deadline)
+            self._loop.call_soon_threadsafe(self._tick, deadline)
+
+    def _tick(self, deadline):
+        now = time.time()
+        self._tick_late.append(now - deadline)
+        if self._last is not None:
+            last_deadline, last_t = self._last
+            # How far the time between ticks strayed from the time between
+            # their deadlines.
+            self._intervals.append((now - last_t) - (deadline - last_deadline))
+        self._last = (deadline, now)
+        self.on_tick(deadline)
+
+    def stats(self):
+        """Percentiles (p50, p99, p99.9) in seconds of how late the thread
+        woke for the latest ticks and how late on_tick ran, and of the
+        inter-tick jitter: how far each interval between on_tick calls was
+        from the interval between their deadlines."""
+        return {
+            'wake_late': percentiles(self._wake_late),
+            'tick_late': percentiles(self._tick_late),
+            'interval_jitter': percentiles([abs(x) for x in self._intervals]),
+        }
+
+    def report(self):
+        """stats() as a log line, in milliseconds."""
+        parts = [f'{self.name}:']
+        for key, values in self.stats().items():
+            if values is not None:
+                p50, p99, p999 = (v * 1e3 for v in values)
+                parts.append(f'{key} p50 {p50:.3f} p99 {p99:.3f} p99.9 {p999:.3f} ms')
+        if not self.realtime:
+            parts.append('(normal priority)')
+        return '  '.join(parts)
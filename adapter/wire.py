@@ -0,0 +1,280 @@
+"""Websocket wire formats for adapter messages.
+
+Clients pick a format by offering websocket subprotocols during the handshake
+(see web/src/wire.js). Clients that offer none, or only the JSON one, get the
+original JSON text frames; clients that negotiate the binary subprotocol get
+the fixed-layout struct frames described in message.py.
+
+Every frame sent to a client is a batch of the messages produced together
+(e.g. in one clock tick): a JSON object {"msg_type": BATCH, "latency": ...,
+"msgs": [...]}, or a binary BATCH header followed by the binary message frames
+back to back. The batch's latency is the receiving client's own estimated
+one-way latency (see clients.py), which the client adds to each message's
+latency field. The messages themselves are encoded once for all clients.
+"""
+import json
+import struct
+import time
+from typing import NamedTuple, Optional
+
+import websockets
+
+from message import Msg, MsgPing
+
+SUBPROTOCOL_BINARY = 'visync.bin'
+SUBPROTOCOL_JSON = 'visync.json'
+
+# Server preference order, passed to websockets.serve(subprotocols=...).
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]
+
+# Binary ACK sent back by clients: msg_type (u8), the echoed t (f64) and the
+# client's own clock when it received the message (f64).
+BINARY_ACK = struct.Struct('<Bdd')
+
+# Binary SUBSCRIBE, sent by clients that want only some broadcast messages:
+# msg_type (u8), then bitmasks (u32) of the wanted msg_types and beat
+# channels, bit n standing for value n, then sync_every (u16, see
+# Subscription). SUBSCRIBE_ALL means no filtering.
+BINARY_SUBSCRIBE = struct.Struct('<BIIH')
+SUBSCRIBE_ALL = 0xffffffff
+
+# Syncs that depart from the tempo and phase clients would extrapolate from
+# the last keyframe sync by more than these are keyframes too (see
+# SyncKeyframes).
+SYNC_RATE_TOLERANCE = 0.002
+SYNC_PHASE_TOLERANCE_S = 0.003
+
+# Binary batch header: msg_type BATCH (u8), the client's latency (f32) and the
+# message count (u16). Binary message frames have a size determined by their
+# msg_type and body, so no per-message lengths are needed.
+BINARY_BATCH_HEADER = struct.Struct('<BfH')
+
+JSON_BATCH_PREFIX = '{"msg_type": %d, "latency": %%r, "msgs": [' % Msg.Type.BATCH
+
+
+class Subscription(NamedTuple):
+    """Which broadcast messages a client wants: those with a msg_type in
+    `msg_types` and, of beats, only those on `channels`. None means no
+    filtering. Of syncs, a client with `sync_every` N > 1 wants only every
+    Nth sync_idx plus keyframes (see SyncKeyframes), and fills in the rest
+    itself. Pings and a client's own messages (Client.outbox) always go out
+    regardless."""
+    msg_types: Optional[frozenset] = None
+    channels: Optional[frozenset] = None
+    sync_every: int = 1
+
+    def wants(self, msg):
+        if self.msg_types is not None and msg.msg_type not in self.msg_types:
+            return False
+        if self.channels is not None and msg.msg_type == Msg.Type.BEAT:
+            return msg.channel in self.channels
+        if self.sync_every > 1 and msg.msg_type == Msg.Type.SYNC:
+            return msg._keyframe or msg.sync_idx % self.sync_every == 0
+        return True
+
+    def filter(self, msgs):
+        return [msg for msg in msgs if self.wants(msg)]
+
+
+class SyncKeyframes:
+    """Follows the sync stream the way a client taking only some syncs does:
+    extrapolating sync_idx from the tempo and phase of the last keyframe.
+    Marks as a keyframe each sync that the extrapolation doesn't predict to
+    within SYNC_RATE_TOLERANCE and SYNC_PHASE_TOLERANCE_S, or that doesn't
+    follow on from the sync before (a reset, a new source)."""
+
+    def __init__(self):
+        self.anchor = None   # (t, sync_idx, sync_rate_hz) of the last keyframe
+        self.last_idx = None
+
+    def mark(self, msg):
+        if msg._keyframe is not None:
+            return
+        keyframe = self.anchor is None or msg.sync_idx != self.last_idx + 1
+        if not keyframe:
+            t, sync_idx, sync_rate_hz = self.anchor
+            predicted_t = t + (msg.sync_idx - sync_idx) / sync_rate_hz
+            keyframe = (abs(msg.sync_rate_hz - sync_rate_hz) > SYNC_RATE_TOLERANCE * sync_rate_hz
+                        or abs(msg.t - predicted_t) > SYNC_PHASE_TOLERANCE_S)
+        if keyframe:
+            self.anchor = (msg.t, msg.sync_idx, msg.sync_rate_hz)
+        self.last_idx = msg.sync_idx
+        msg._keyframe = keyframe
+
+
+# The one sync stream each process broadcasts.
+sync_keyframes = SyncKeyframes()
+
+# Everything broadcast in this process is handed to each of these, whether
+# or not any client is connected: objects with an observe(msgs) method, like
+# the show state (state.StateModel) and fanout.FanoutPublisher.
+observers = []
+
+
+def is_binary(websocket):
+    return websocket.subprotocol == SUBPROTOCOL_BINARY
+
+
+def encode_batch_body(msgs, binary):
+    """Encode the client-independent part of a batch frame. Each message's own
+    frame comes from its encode cache (see Msg.encode), so batching adds no
+    serialization work."""
+    if binary:
+        return b''.join([msg.encode(True) for msg in msgs])
+    return ','.join([msg.encode(False) for msg in msgs])
+
+
+def encode_batch(body, count, binary, latency):
+    """Wrap a body from encode_batch_body() into a batch frame stamped with
+    one client's latency."""
+    if binary:
+        return BINARY_BATCH_HEADER.pack(Msg.Type.BATCH, latency, count) + body
+    return (JSON_BATCH_PREFIX % float(latency)) + body + ']}'
+
+
+def encode_frames(msgs, binary, latency):
+    """Encode `msgs` for one client as one batch frame, or two for a binary
+    client if some messages have no binary layout."""
+    if not binary:
+        return [encode_batch(encode_batch_body(msgs, False), len(msgs), False, latency)]
+    binary_msgs = [msg for msg in msgs if msg.BINARY_BODY is not None]
+    json_only_msgs = [msg for msg in msgs if msg.BINARY_BODY is None]
+    frames = []
+    for group, group_binary in ((binary_msgs, True), (json_only_msgs, False)):
+        if group:
+            frames.append(encode_batch(encode_batch_body(group, group_binary),
+                                       len(group), group_binary, latency))
+    return frames
+
+
+def broadcast_batch(clients, msgs):
+    """Send `msgs` to each of `clients` (clients.Client objects) as one frame
+    in the format it negotiated. Messages are encoded at most once per format;
+    only the few bytes of batch header are built per client. Clients that are
+    due a ping (see Client.ping_due) get a shared MsgPing appended, and any
+    messages addressed to just that client (Client.outbox) after that.
+    Clients that are behind get the messages in their send queue instead (see
+    Client.enqueue). `observers` see the messages first."""
+    if not clients and not observers:
+        return
+    for msg in msgs:
+        if msg.msg_type == Msg.Type.SYNC:
+            sync_keyframes.mark(msg)
+    for observer in observers:
+        observer.observe(msgs)
+    if not clients:
+        return
+    # Messages split by subscription (see Subscription), computed the first
+    # time a client with that subscription comes up, and bodies encoded
+    # lazily the first time a client needs them, so nothing is encoded for a
+    # group nobody subscribed to.
+    groups = {}
+    bodies = {}
+
+    def group(subscription):
+        if subscription not in groups:
+            wanted = msgs if subscription is None else subscription.filter(msgs)
+            groups[subscription] = (
+                wanted,
+                [msg for msg in wanted if msg.BINARY_BODY is not None],
+                [msg for msg in wanted if msg.BINARY_BODY is None],
+            )
+        return groups[subscription]
+
+    def body(key, group, binary):
+        if key not in bodies:
+            bodies[key] = encode_batch_body(group, binary)
+        return bodies[key]
+
+    now = time.time()
+    ping = None
+    for client in clients:
+        ping_due = client.ping_due(now)
+        if ping_due and ping is None:
+            ping = MsgPing()
+        wanted, binary_msgs, json_only_msgs = group(client.subscription)
+        if client.behind():
+            client.enqueue(wanted + ([ping] if ping_due else []) + client.outbox)
+            client.outbox = []
+            continue
+        latency = client.latency.latency_s
+        # Binary clients get messages without a binary layout in a separate
+        # JSON batch.
+        if client.binary:
+            main_group, main_binary, key = binary_msgs, True, 'binary'
+        else:
+            main_group, main_binary, key = wanted, False, 'json'
+        if ping_due:
+            main_group = main_group + [ping]
+            key += '+ping'
+        frames = []
+        if main_group or client.outbox:
+            main_body = body((client.subscription, key), main_group, main_binary)
+            count = len(main_group)
+            if client.outbox:
+                # Per-client messages are rare (a few a second), so they're
+                # simply encoded onto the end of the shared body.
+                own_body = encode_batch_body(client.outbox, main_binary)
+                if main_binary or not count:
+                    main_body += own_body
+                else:
+                    main_body += ',' + own_body
+                count += len(client.outbox)
+                client.outbox = []
+            frames.append(encode_batch(main_body, count, main_binary, latency))
+        if client.binary and json_only_msgs:
+            frames.append(encode_batch(body((client.subscription, 'json_only'),
+                                            json_only_msgs, False),
+                                       len(json_only_msgs), False, latency))
+        for frame in frames:
+            websockets.broadcast([client.websocket], frame)
+
+
+def broadcast(clients, msg):
+    """Send a single message to each client in the format it negotiated."""
+    broadcast_batch(clients, [msg])
+
+
+class Batch:
+    """Collects the messages produced during one clock tick so they go out as
+    a single frame per client instead of one frame per message."""
+
+    def __init__(self, clients):
+        self.clients = clients
+        self.msgs = []
+
+    def add(self, msg):
+        self.msgs.append(msg)
+
+    def flush(self):
+        if self.msgs:
+            broadcast_batch(self.clients, self.msgs)
+            self.msgs = []
+
+
+def _from_mask(mask):
+    if mask == SUBSCRIBE_ALL:
+        return None
+    return frozenset(n for n in range(32) if mask & (1 << n))
+
+
+def decode_client_msg(message):
+    """Decode a message from a client, in either format: an ACK as
+    (Msg.Type.ACK, (t, t_client)), where t is the echoed `t` and t_client
+    the client's clock when it received the message, or a SUBSCRIBE as (Msg.Type.SUBSCRIBE, Subscription)."""
+    if isinstance(message, bytes):
+        if message[0] == Msg.Type.SUBSCRIBE:
+            _msg_type, msg_types, channels, sync_every = BINARY_SUBSCRIBE.unpack_from(message)
+            return Msg.Type.SUBSCRIBE, Subscription(_from_mask(msg_types), _from_mask(channels),
+                                                    max(1, sync_every))
+        _msg_type, t, t_client = BINARY_ACK.unpack_from(message)
+        return Msg.Type.ACK, (t, t_client)
+    msg = json.loads(message)
+    if msg['msg_type'] == Msg.Type.SUBSCRIBE:
+        msg_types = msg.get('msg_types')
+        channels = msg.get('channels')
+        return Msg.Type.SUBSCRIBE, Subscription(
+            None if msg_types is None else frozenset(msg_types),
+            None if channels is None else frozenset(channels),
+            max(1, int(msg.get('sync_every', 1))))
+    return Msg.Type.ACK, (msg['t'], msg['t_client'])
@@ -51,28 +51,39 @@ import {
     clamp
 } from './src/util.js';
 import { BoxDef } from './src/geom_def.js';
-import { WebsocketController, Binding } from './src/controller.js';
+import { KnobController, Binding } from './src/controller.js';
+import {
+    MSG_TYPE_SYNC,
+    MSG_TYPE_BEAT,
+    MSG_TYPE_GOTO_SCENE,
+    MSG_TYPE_ADVANCE_SCENE_STATE,
+    MSG_TYPE_PING,
+    MSG_TYPE_CLOCK_SYNC,
+    MSG_TYPE_CONTROL_CHANGE,
+    MSG_TYPE_KNOB_VECTOR,
+    MSG_TYPE_PREPARE_SCENE,
+    open_socket,
+    decode_frame,
+    encode_ack,
+    encode_subscribe
+} from './src/wire.js';
+import { ServerClock, now_s } from './src/server_clock.js';
+import { SyncInterpolator } from './src/sync_interpolator.js';
 
 import "./src/normalize.css";
 import "./src/style.css";
 
 
-const MSG_TYPE_SYNC = 0;
-const MSG_TYPE_BEAT = 1;
-const MSG_TYPE_GOTO_SCENE = 2;
-const MSG_TYPE_ADVANCE_SCENE_STATE = 3;
-const MSG_TYPE_PROMOTION = 4;
-const MSG_TYPE_PROMOTION_GRANT = 5;
-const MSG_TYPE_ACK = 6;
-const MSG_TYPE_PITCH_BEND = 7;
-const MSG_TYPE_CONTROL_CHANGE = 8;
-
 const SKEW_SMOOTHING = 0.99;
 const LATENCY_SMOOTHING = 0.9;
 const STALE_THRESHOLD = 0.1;
 //const EXTRA_LATENCY = 0.220;
 const EXTRA_LATENCY = 0.0;
 
+// The adapter sends one sync per beat (plus any that change tempo or phase);
+// the SyncInterpolator fills in the other 23.
+const SYNC_EVERY = 24;
+
 const ENABLE_GLOBAL_TRACERS = false;
 const BG_COLOR = 'black';
 
@@ -81,6 +92,8 @@ const SCENES_PER_BANK = 10;
 const MIN_SWIPE_LENGTH = 50;
 
 var context = null;
+var server_clock = new ServerClock();
+var sync_interpolator = null;
 var stats = new Stats();
 
 window.addEventListener("load", init);
@@ -96,62 +109,95 @@ function relay_url() {
 }
 
 
-function connect() {
-    const socket = new WebSocket(relay_url());
-    socket.addEventListener('message', function(e) {
-	const msg = JSON.parse(e.data);
-        const type = msg.msg_type;
-
-        // Estimate clock skew
-        const t_now = Date.now() / 1000;
-        const skew = t_now - msg.t;
-        context.est_avg_skew = context.est_avg_skew ? 
-            context.est_avg_skew * SKEW_SMOOTHING + skew * (1 - SKEW_SMOOTHING) :
-            skew;
-
-        // Discard stale messages
-        if (skew - context.est_avg_skew > STALE_THRESHOLD) {
-            return;
-        }
+function handle_msg(socket, msg) {
+    const type = msg.msg_type;
 
-        // Update average latency with the one-way latency seen last
-        context.est_avg_latency = context.est_avg_latency ?
-            context.est_avg_latency * LATENCY_SMOOTHING + msg.latency * (1 - LATENCY_SMOOTHING) :
-            msg.latency;
-
-        /*const est_tot_latency = skew - context.est_avg_skew // extra latency of just this message
-            + context.est_avg_latency   // average latency
-            + EXTRA_LATENCY;            // extra latency (manual calibration)*/
-        const est_tot_latency = /*msg.latency +*/ EXTRA_LATENCY;
-
-        //console.log(`Skew: ${skew} | ${context.est_avg_skew}`);
-        //console.log(`Latency: ${context.est_avg_latency}`);
-
-        // Update the overlay with latency
-        const latency_elem = document.getElementById('latency');
-        const latency_str = `${(est_tot_latency * 1000).toFixed(1)}`.substring(0, 4).padEnd(4);
-        latency_elem.innerHTML = latency_str;
-
-        if (type == MSG_TYPE_SYNC) {
-            context.handle_sync(est_tot_latency, msg.sync_rate_hz, msg.sync_idx);
-        } else if (type == MSG_TYPE_BEAT) {
-            context.handle_beat(est_tot_latency, msg.channel);
-        } else if (type == MSG_TYPE_ADVANCE_SCENE_STATE) {
-            context.advance_state(msg.steps);
-        } else if (type == MSG_TYPE_GOTO_SCENE) {
-            context.change_scene(msg.scene, msg.bg);
-        }
-        const resp = {msg_type: MSG_TYPE_ACK, t: msg.t};
-        socket.send(JSON.stringify(resp));
+    // The adapter measures our latency from ACKs of its pings only.
+    if (type == MSG_TYPE_PING) {
+        socket.send(encode_ack(socket, msg.t, now_s()));
+        return;
+    }
+    if (type == MSG_TYPE_CLOCK_SYNC) {
+        server_clock.update(msg);
+        return;
+    }
+    if (type == MSG_TYPE_CONTROL_CHANGE || type == MSG_TYPE_KNOB_VECTOR) {
+        context.hub_controller.handle_message(msg);
+        return;
+    }
+
+    // Estimate clock skew
+    const t_now = Date.now() / 1000;
+    const skew = t_now - msg.t;
+    context.est_avg_skew = context.est_avg_skew ? 
+        context.est_avg_skew * SKEW_SMOOTHING + skew * (1 - SKEW_SMOOTHING) :
+        skew;
 
-        // Update the overlay with last msg contents
-        if (type != MSG_TYPE_SYNC) {
-            const last_msg_elem = document.getElementById('lastmsg');
-            last_msg_elem.innerHTML = msg_to_disp_string(msg);
+    // Discard stale messages
+    if (skew - context.est_avg_skew > STALE_THRESHOLD) {
+        return;
+    }
+
+    // Update average latency with the one-way latency seen last
+    context.est_avg_latency = context.est_avg_latency ?
+        context.est_avg_latency * LATENCY_SMOOTHING + msg.latency * (1 - LATENCY_SMOOTHING) :
+        msg.latency;
+
+    /*const est_tot_latency = skew - context.est_avg_skew // extra latency of just this message
+        + context.est_avg_latency   // average latency
+        + EXTRA_LATENCY;            // extra latency (manual calibration)*/
+    // Once our clock is synced to the adapter's, msg.t pins down exactly how
+    // long ago the message was sent on our own clock.
+    const est_tot_latency = server_clock.synced ?
+        server_clock.since(msg.t) + EXTRA_LATENCY :
+        /*msg.latency +*/ EXTRA_LATENCY;
+
+    //console.log(`Skew: ${skew} | ${context.est_avg_skew}`);
+    //console.log(`Latency: ${context.est_avg_latency}`);
+
+    // Update the overlay with latency
+    const latency_elem = document.getElementById('latency');
+    const latency_str = `${(est_tot_latency * 1000).toFixed(1)}`.substring(0, 4).padEnd(4);
+    latency_elem.innerHTML = latency_str;
+
+    if (type == MSG_TYPE_SYNC) {
+        sync_interpolator.update(msg);
+    } else if (type == MSG_TYPE_BEAT) {
+        context.handle_beat(est_tot_latency, msg.channel);
+    } else if (type == MSG_TYPE_ADVANCE_SCENE_STATE ||
+            type == MSG_TYPE_GOTO_SCENE) {
+        context.schedule_scene_msg(msg);
+    } else if (type == MSG_TYPE_PREPARE_SCENE) {
+        context.prepare_scene(msg.scene);
+    }
+
+    // Update the overlay with last msg contents
+    if (type != MSG_TYPE_SYNC) {
+        const last_msg_elem = document.getElementById('lastmsg');
+        last_msg_elem.innerHTML = msg_to_disp_string(msg);
+    }
+}
+
+
+function connect() {
+    const socket = open_socket(relay_url());
+    // A restarted adapter may be on a different clock.
+    server_clock = new ServerClock();
+    sync_interpolator = new SyncInterpolator(server_clock, SYNC_EVERY,
+        (latency, sync_rate_hz, sync_idx) => {
+            context.handle_sync(latency + EXTRA_LATENCY, sync_rate_hz, sync_idx);
+        });
+    socket.addEventListener('open', function(e) {
+        socket.send(encode_subscribe(socket, null, null, SYNC_EVERY));
+    });
+    socket.addEventListener('message', function(e) {
+        for (const msg of decode_frame(e.data)) {
+            handle_msg(socket, msg);
         }
     });
 
     socket.addEventListener('close', function(e) {
+        sync_interpolator.stop();
         // Try to reconnect after 1 second
         //console.log('Socket is closed. Reconnect will be attempted in 1 second.', e.reason);
         setTimeout(function() {
@@ -178,6 +224,8 @@ function msg_to_disp_string(msg) {
         msg_txt = `GOTO ${msg.scene} ${msg.bg}`;
     } else if (msg.msg_type == MSG_TYPE_ADVANCE_SCENE_STATE) {
         msg_txt = `ADV ${msg.steps}`;
+    } else if (msg.msg_type == MSG_TYPE_PREPARE_SCENE) {
+        msg_txt = `PREP ${msg.scene}`;
     }
     return msg_txt.substring(0, str_len).padEnd(str_len);
 }
@@ -429,11 +477,14 @@ class GraphicsContext {
         this.renderer.setSize(window.innerWidth, window.innerHeight);
         this.container.appendChild(this.renderer.domElement);
 
-        // Controllers providing live input (knobs/wheels) over WebSockets.
+        // Controllers providing live input (knobs/wheels). Every input source
+        // feeds the adapter hub, whose knob messages arrive on the one socket
+        // opened by connect(), so "apc" and "midi" are the same controller.
         // Created before scenes so scenes can bind to controller knobs.
+        this.hub_controller = new KnobController(this);
         this.controllers = new Map([
-            ["apc", new WebsocketController(this, "ws://localhost:8766")],
-            ["midi", new WebsocketController(this, relay_url())],
+            ["apc", this.hub_controller],
+            ["midi", this.hub_controller],
         ]);
 
         // Create scenes
@@ -485,6 +536,15 @@ class GraphicsContext {
         // Array of scenes on-screen, which are rendered sequentially first-to-last.
         this.shown_scenes = [];
 
+        // Scene messages waiting for the sync they are tagged with, and the
+        // last sync index delivered to the scenes.
+        this.pending_scene_msgs = [];
+        this.last_sync_idx = null;
+
+        // Scenes to draw once, unseen, at the start of the next frame (see
+        // prepare_scene).
+        this.scenes_to_warm = [];
+
         //this.push_scene(23);
         this.cur_scene_bank = 0;
         this.num_scene_banks = Math.ceil((Math.max(...this.scenes.keys()) + 1)
@@ -608,6 +668,14 @@ class GraphicsContext {
     }
 
     render() {
+            // Draw scenes being prepared through their own render path, as
+            // if shown, so everything they use is on the GPU before they
+            // are; this frame's clears below wipe what they drew.
+            this.scenes_to_warm.splice(0).forEach((idx) => {
+                this.renderer.setRenderTarget(null);
+                this.scenes.get(idx).render(this.renderer, this.buffers[0]);
+            });
+
             // Use direct rendering to screen in scene bg -> fg order
 
             // Clear buffer 0 (background)
@@ -712,6 +780,53 @@ class GraphicsContext {
         });
     }
 
+    // Warm up a scene the adapter says is coming, while the current ones
+    // play, so switching to it doesn't drop frames.
+    prepare_scene(scene_idx) {
+        if (!this.scenes.has(scene_idx) || this.shown_scenes.includes(scene_idx)) {
+            return;
+        }
+        this.scenes.get(scene_idx).prepare(this.renderer).then(() => {
+            this.scenes_to_warm.push(scene_idx);
+        }).catch((e) => {
+            console.log(`preparing scene ${scene_idx} failed: `, e);
+        });
+    }
+
+    // Apply a scene message from the adapter on the sync it is tagged with
+    // (at_sync_idx), or now if it isn't tagged or no syncs are coming in.
+    schedule_scene_msg(msg) {
+        if (!(msg.at_sync_idx >= 0) || this.last_sync_idx === null) {
+            this.apply_scene_msg(msg);
+        } else {
+            this.pending_scene_msgs.push(msg);
+        }
+    }
+
+    apply_scene_msg(msg) {
+        if (msg.msg_type == MSG_TYPE_ADVANCE_SCENE_STATE) {
+            this.advance_state(msg.steps);
+        } else if (msg.msg_type == MSG_TYPE_GOTO_SCENE) {
+            this.change_scene(msg.scene, msg.bg);
+        }
+    }
+
+    // Apply the pending scene messages due by `sync_idx`, in the order they
+    // came; all of them if the sync count went back (a reset).
+    apply_due_scene_msgs(sync_idx) {
+        const reset = this.last_sync_idx !== null && sync_idx < this.last_sync_idx;
+        this.last_sync_idx = sync_idx;
+        const pending = this.pending_scene_msgs;
+        this.pending_scene_msgs = [];
+        pending.forEach((msg) => {
+            if (reset || msg.at_sync_idx <= sync_idx) {
+                this.apply_scene_msg(msg);
+            } else {
+                this.pending_scene_msgs.push(msg);
+            }
+        });
+    }
+
     keydown(e) {
         const num = parseInt(e.key);
         const shift_chars = ')!@#$%^&*(';
@@ -757,6 +872,7 @@ class GraphicsContext {
 
         // Wait until the next beat to deliver the sync message
         setTimeout(() => {
+            this.apply_due_scene_msgs(beat + 1);
             this.scenes.forEach((scene) => {
                 scene.handle_sync_raw(sync_rate_hz, beat + 1);
             });
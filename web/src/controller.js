@@ -1,7 +1,9 @@
-// Message type for a control change (e.g. a knob or wheel being turned).
-const MSG_TYPE_CONTROL_CHANGE = 8;
+import {
+    MSG_TYPE_CONTROL_CHANGE,
+    MSG_TYPE_KNOB_VECTOR
+} from './wire.js';
 
-// Number of knobs exposed by a WebsocketController.
+// Number of knobs exposed by a KnobController.
 const NUM_KNOBS = 16;
 
 export class Knob {
@@ -44,44 +46,33 @@ export class Controller {
     handle_message(msg) {}
 }
 
-// A Controller that receives its events over a WebSocket connection.
-export class WebsocketController extends Controller {
-    constructor(context, url) {
+// A Controller whose knobs are set by the adapter's control-change and knob
+// vector messages. Whoever receives them passes them to handle_message().
+export class KnobController extends Controller {
+    constructor(context) {
         super(context);
-        this.url = url;
         for (let i = 0; i < NUM_KNOBS; i++) {
             // Knob values arrive already normalized to [0, 1] from the adapter.
             this.add_knob(i);
         }
-        this.connect();
-    }
-
-    connect() {
-        this.socket = new WebSocket(this.url);
-        this.socket.addEventListener('message', (e) => this.on_message(e));
-        this.socket.addEventListener('close', () => {
-            // Try to reconnect after 1 second
-            setTimeout(() => this.connect(), 1000);
-        });
-        this.socket.addEventListener('error', (e) => {
-            console.log('Socket encountered error: ', e, 'Closing socket');
-            this.socket.close();
-        });
     }
 
-    on_message(e) {
-        const msg = JSON.parse(e.data);
-        console.log(msg)
-        this.handle_message(msg);
+    set_knob(wheel_idx, value) {
+        const knob = this.knobs.get(wheel_idx);
+        if (knob) {
+            // Value is normalized [0, 1]; clamp defensively.
+            knob.cur_val = Math.max(0, Math.min(1, value));
+        }
     }
 
     handle_message(msg) {
         if (msg.msg_type == MSG_TYPE_CONTROL_CHANGE) {
-            const knob = this.knobs.get(msg.wheel_idx);
-            if (knob) {
-                // Value is normalized [0, 1]; clamp defensively.
-                knob.cur_val = Math.max(0, Math.min(1, msg.value));
-            }
+            this.set_knob(msg.wheel_idx, msg.value);
+        } else if (msg.msg_type == MSG_TYPE_KNOB_VECTOR) {
+            // Coalesced latest values of several knobs at once.
+            msg.wheel_idxs.forEach((wheel_idx, i) => {
+                this.set_knob(wheel_idx, msg.values[i]);
+            });
         }
     }
 }
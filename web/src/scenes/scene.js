@@ -145,6 +145,16 @@ export class Scene extends THREE.Scene {
         renderer.render(this, this.camera);
     }
 
+    // Start getting ready to be shown: compile the shader programs for this
+    // scene's camera, off the main thread where the browser can. The rest
+    // (programs for any inner scenes, cameras or passes of an overridden
+    // render(), and geometry and texture uploads) happens when the context
+    // then draws the scene once through render() (see
+    // GraphicsContext.prepare_scene).
+    prepare(renderer) {
+        return renderer.compileAsync(this, this.camera);
+    }
+
     activate() {
         this.active = true;
     }
@@ -0,0 +1,35 @@
+// Maps adapter timestamps onto this browser's clock, using the offset and
+// drift the adapter estimates from our ping ACKs (see adapter/clients.py) and
+// sends us as CLOCK_SYNC messages.
+
+// Our wall clock in seconds, at sub-millisecond resolution.
+export function now_s() {
+    return (performance.timeOrigin + performance.now()) / 1000;
+}
+
+export class ServerClock {
+    constructor() {
+        this.synced = false;
+        this.offset = 0;
+        this.ref_t = 0;
+        this.drift = 0;
+    }
+
+    update(msg) {
+        this.offset = msg.offset;
+        this.ref_t = msg.ref_t;
+        this.drift = msg.drift;
+        this.synced = true;
+    }
+
+    // Our clock's reading at adapter time `server_t`.
+    to_local(server_t) {
+        return server_t + this.offset + this.drift * (server_t - this.ref_t);
+    }
+
+    // Seconds since adapter time `server_t` on our clock; negative if it's
+    // still in the future.
+    since(server_t) {
+        return now_s() - this.to_local(server_t);
+    }
+}
@@ -0,0 +1,81 @@
+// Fills in the syncs the adapter leaves out for clients that subscribe with
+// sync_every > 1 (see encode_subscribe). Each sync received re-anchors a
+// model of sync_idx over time at that sync's rate; every index is then
+// emitted in turn, at its due time by the model, so hooks keyed to
+// sync_idx % N fire as if every sync had been sent. Indices never go
+// backwards, except on a reset of the adapter's count.
+
+import { now_s } from './server_clock.js';
+
+// A sync this far behind the indices already emitted is a reset (e.g. a new
+// song), not the model running a little ahead.
+const RESET_BACKSTEP = 24;
+
+// After a sync, indices are extrapolated this many multiples of sync_every
+// ahead at most, so they stop when the adapter's syncs do.
+const MAX_EXTRAPOLATE = 2;
+
+// A sync this far ahead of the indices emitted skips the ones in between
+// rather than emitting them all at once.
+const MAX_CATCH_UP = 48;
+
+export class SyncInterpolator {
+    // `emit(latency, sync_rate_hz, sync_idx)` is called for every index, with
+    // the seconds since it was due on our clock.
+    constructor(server_clock, sync_every, emit) {
+        this.server_clock = server_clock;
+        this.sync_every = sync_every;
+        this.emit = emit;
+        this.anchor_t = null;    // our clock's time of anchor_idx
+        this.anchor_idx = 0;
+        this.sync_rate_hz = 0;
+        this.next_idx = null;    // next index to emit
+        this.last_idx = null;    // last index the adapter sent
+        this.timer = null;
+    }
+
+    update(msg) {
+        // A reset starts the count again from 0. Early in a song that is
+        // less than RESET_BACKSTEP back, but still behind the last sync.
+        const reset = msg.sync_idx === 0 ||
+            (this.last_idx !== null && msg.sync_idx < this.last_idx) ||
+            msg.sync_idx < this.next_idx - RESET_BACKSTEP;
+        this.anchor_t = this.server_clock.synced ?
+            this.server_clock.to_local(msg.t) : now_s();
+        this.anchor_idx = msg.sync_idx;
+        this.sync_rate_hz = msg.sync_rate_hz;
+        this.last_idx = msg.sync_idx;
+        if (this.next_idx === null || reset || msg.sync_idx > this.next_idx + MAX_CATCH_UP) {
+            this.next_idx = msg.sync_idx;
+        }
+        this.run();
+    }
+
+    due_t(sync_idx) {
+        return this.anchor_t + (sync_idx - this.anchor_idx) / this.sync_rate_hz;
+    }
+
+    // Emit every index that is due, and wait for the next.
+    run() {
+        clearTimeout(this.timer);
+        this.timer = null;
+        if (this.next_idx === null) {
+            return;
+        }
+        const now = now_s();
+        const last = this.last_idx + MAX_EXTRAPOLATE * this.sync_every;
+        while (this.next_idx <= last && this.due_t(this.next_idx) <= now) {
+            this.emit(now - this.due_t(this.next_idx), this.sync_rate_hz, this.next_idx);
+            this.next_idx++;
+        }
+        if (this.next_idx <= last) {
+            const delay = this.due_t(this.next_idx) - now;
+            this.timer = setTimeout(() => this.run(), delay * 1000);
+        }
+    }
+
+    stop() {
+        clearTimeout(this.timer);
+        this.timer = null;
+    }
+}
@@ -0,0 +1,182 @@
+// Websocket wire formats shared with the adapter (see adapter/wire.py and
+// adapter/message.py).
+
+export const MSG_TYPE_SYNC = 0;
+export const MSG_TYPE_BEAT = 1;
+export const MSG_TYPE_GOTO_SCENE = 2;
+export const MSG_TYPE_ADVANCE_SCENE_STATE = 3;
+export const MSG_TYPE_PROMOTION = 4;
+export const MSG_TYPE_PROMOTION_GRANT = 5;
+export const MSG_TYPE_ACK = 6;
+export const MSG_TYPE_PITCH_BEND = 7;
+export const MSG_TYPE_CONTROL_CHANGE = 8;
+export const MSG_TYPE_PROGRAM_CHANGE = 9;
+export const MSG_TYPE_BATCH = 10;
+export const MSG_TYPE_KNOB_VECTOR = 11;
+export const MSG_TYPE_PING = 12;
+export const MSG_TYPE_CLOCK_SYNC = 13;
+export const MSG_TYPE_SUBSCRIBE = 14;
+export const MSG_TYPE_PREPARE_SCENE = 15;
+
+const SUBPROTOCOL_BINARY = 'visync.bin';
+const SUBPROTOCOL_JSON = 'visync.json';
+
+// Binary frames are little-endian: a common header of msg_type (u8), t (f64)
+// and latency (f32), followed by a fixed-layout body that depends on msg_type.
+// The adapter wraps every frame in a BATCH: msg_type (u8), this client's
+// estimated one-way latency (f32) and a count (u16), followed by that many
+// message frames back to back. JSON batches are {msg_type, latency, msgs}.
+const HEADER_SIZE = 13;
+const BATCH_HEADER_SIZE = 7;
+const ACK_SIZE = 17;
+const SUBSCRIBE_SIZE = 11;
+const SUBSCRIBE_ALL = 0xffffffff;
+
+// msg_type -> [body size in bytes, body decoder]. Variable-length bodies give
+// their size as a function of (view, body offset) instead.
+const BODIES = new Map([
+    [MSG_TYPE_SYNC, [8, (view, o) => ({
+        sync_rate_hz: view.getFloat32(o, true),
+        sync_idx: view.getInt32(o + 4, true),
+    })]],
+    [MSG_TYPE_BEAT, [2, (view, o) => ({
+        channel: view.getUint8(o),
+        on: view.getUint8(o + 1) != 0,
+    })]],
+    // Scene messages take effect on sync index at_sync_idx, or at once if -1.
+    [MSG_TYPE_GOTO_SCENE, [7, (view, o) => ({
+        scene: view.getUint16(o, true),
+        bg: view.getUint8(o + 2) != 0,
+        at_sync_idx: view.getInt32(o + 3, true),
+    })]],
+    [MSG_TYPE_ADVANCE_SCENE_STATE, [6, (view, o) => ({
+        steps: view.getInt16(o, true),
+        at_sync_idx: view.getInt32(o + 2, true),
+    })]],
+    // A hint that a scene goes on screen at sync index at_sync_idx.
+    [MSG_TYPE_PREPARE_SCENE, [6, (view, o) => ({
+        scene: view.getUint16(o, true),
+        at_sync_idx: view.getInt32(o + 2, true),
+    })]],
+    [MSG_TYPE_PITCH_BEND, [2, (view, o) => ({
+        value: view.getUint16(o, true),
+    })]],
+    [MSG_TYPE_CONTROL_CHANGE, [5, (view, o) => ({
+        wheel_idx: view.getUint8(o),
+        value: view.getFloat32(o + 1, true),
+    })]],
+    [MSG_TYPE_PROGRAM_CHANGE, [2, (view, o) => ({
+        channel: view.getUint8(o),
+        value: view.getUint8(o + 1),
+    })]],
+    // Knob count (u8), then a wheel_idx (u8) and value (f32) per knob.
+    [MSG_TYPE_KNOB_VECTOR, [(view, o) => 1 + 5 * view.getUint8(o), (view, o) => {
+        const count = view.getUint8(o);
+        const wheel_idxs = [];
+        const values = [];
+        for (let i = 0; i < count; i++) {
+            wheel_idxs.push(view.getUint8(o + 1 + 5 * i));
+            values.push(view.getFloat32(o + 2 + 5 * i, true));
+        }
+        return {wheel_idxs: wheel_idxs, values: values};
+    }]],
+    // Pings have no body; only the header's t matters (echoed in the ACK).
+    [MSG_TYPE_PING, [0, (view, o) => ({})]],
+    [MSG_TYPE_CLOCK_SYNC, [20, (view, o) => ({
+        offset: view.getFloat64(o, true),
+        ref_t: view.getFloat64(o + 8, true),
+        drift: view.getFloat32(o + 16, true),
+    })]],
+]);
+
+// Open a socket to the adapter, offering the binary format first and JSON as
+// a fallback.
+export function open_socket(url) {
+    const socket = new WebSocket(url, [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]);
+    socket.binaryType = 'arraybuffer';
+    return socket;
+}
+
+// Decode the binary message frame starting at byte `offset` of `view`.
+// Returns [msg, offset just past the frame].
+function decode_binary_msg(view, offset) {
+    const msg = {
+        msg_type: view.getUint8(offset),
+        t: view.getFloat64(offset + 1, true),
+        latency: view.getFloat32(offset + 9, true),
+    };
+    const body_offset = offset + HEADER_SIZE;
+    const [size, decode_body] = BODIES.get(msg.msg_type);
+    Object.assign(msg, decode_body(view, body_offset));
+    const body_size = (typeof size === 'function') ? size(view, body_offset) : size;
+    return [msg, body_offset + body_size];
+}
+
+// Decode one incoming frame (text or binary) into an array of message objects
+// shaped like the adapter's JSON messages. The batch's per-client latency is
+// added to each message's own latency.
+export function decode_frame(data) {
+    if (typeof data === 'string') {
+        const parsed = JSON.parse(data);
+        if (parsed.msg_type != MSG_TYPE_BATCH) {
+            return [parsed];
+        }
+        parsed.msgs.forEach((msg) => { msg.latency += parsed.latency; });
+        return parsed.msgs;
+    }
+    const view = new DataView(data);
+    if (view.getUint8(0) != MSG_TYPE_BATCH) {
+        return [decode_binary_msg(view, 0)[0]];
+    }
+    const latency = view.getFloat32(1, true);
+    const count = view.getUint16(5, true);
+    const msgs = [];
+    let offset = BATCH_HEADER_SIZE;
+    for (let i = 0; i < count; i++) {
+        const [msg, next] = decode_binary_msg(view, offset);
+        msg.latency += latency;
+        msgs.push(msg);
+        offset = next;
+    }
+    return msgs;
+}
+
+// Encode an ACK echoing a ping's time `t`, in the socket's negotiated format,
+// along with our own clock when the ping arrived (`t_client`, in seconds) for
+// the adapter's clock offset estimate. The adapter only asks for ACKs on
+// pings, a few times a second.
+export function encode_ack(socket, t, t_client) {
+    if (socket.protocol != SUBPROTOCOL_BINARY) {
+        return JSON.stringify({msg_type: MSG_TYPE_ACK, t: t, t_client: t_client});
+    }
+    const buf = new ArrayBuffer(ACK_SIZE);
+    const view = new DataView(buf);
+    view.setUint8(0, MSG_TYPE_ACK);
+    view.setFloat64(1, t, true);
+    view.setFloat64(9, t_client, true);
+    return buf;
+}
+
+// Encode a SUBSCRIBE asking the adapter to send only broadcast messages with a
+// msg_type in `msg_types` and, of beats, only those on `channels` (either may
+// be null for no filtering). With `sync_every` N > 1, only every Nth sync is
+// sent, plus any that change tempo or phase; the client fills in the rest
+// (see SyncInterpolator). Pings and clock syncs are always sent.
+export function encode_subscribe(socket, msg_types, channels = null, sync_every = 1) {
+    if (socket.protocol != SUBPROTOCOL_BINARY) {
+        const msg = {msg_type: MSG_TYPE_SUBSCRIBE};
+        if (msg_types !== null) msg.msg_types = msg_types;
+        if (channels !== null) msg.channels = channels;
+        if (sync_every > 1) msg.sync_every = sync_every;
+        return JSON.stringify(msg);
+    }
+    const to_mask = (values) => (values === null) ? SUBSCRIBE_ALL :
+        values.reduce((mask, n) => (mask | (1 << n)) >>> 0, 0);
+    const buf = new ArrayBuffer(SUBSCRIBE_SIZE);
+    const view = new DataView(buf);
+    view.setUint8(0, MSG_TYPE_SUBSCRIBE);
+    view.setUint32(1, to_mask(msg_types), true);
+    view.setUint32(5, to_mask(channels), true);
+    view.setUint16(9, sync_every, true);
+    return buf;
+}